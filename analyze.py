@@ -0,0 +1,328 @@
+"""Static cost model of a PeleeNet variant: where its compute and memory traffic go.
+
+Runs one forward pass of the variant at the given input size with hooks on
+every layer (the BasicConv2d units and the modules outside of them, as in
+profiling.LayerProfiler) and reports per layer the MACs, parameters, output
+activation bytes and the bytes read and written, the copy traffic of every
+concatenation, the dense layers whose inter_channel was adjusted down, and the
+peak live-activation memory for inference and training.
+
+Each layer is placed on a roofline: FLOPs per byte against the ridge point of
+the machine, from --peak-gflops/--peak-gbs or a quick GEMM and copy
+measurement. --measure then times the layers with LayerProfiler and checks the
+model against the measurement.
+
+Usage: python analyze.py [--growth-rate 32] [--block-config 3,4,8,6] [--bottleneck-width 1,2,4,4]
+                         [--input-dim 224] [-b 1] [--optimize] [--measure] [--csv PATH]
+"""
+import argparse
+import csv
+import time
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.quantization import DeQuantStub, QuantStub
+
+from peleenet import PeleeNet, _DenseBlock, _DenseLayer, _GlobalPoolLinear, _StemBlock
+from profiling import LayerProfiler, layers
+
+
+def int_or_list(text):
+    values = [int(v) for v in text.split(',')]
+    return values[0] if len(values) == 1 else values
+
+
+parser = argparse.ArgumentParser(description='PeleeNet per-layer cost analyzer')
+parser.add_argument('--growth-rate', default='32', type=int_or_list,
+                    help='growth rate, or 4 comma separated ones (default: 32)')
+parser.add_argument('--block-config', default='3,4,8,6', type=int_or_list,
+                    help='layers per dense block (default: 3,4,8,6)')
+parser.add_argument('--bottleneck-width', default='1,2,4,4', type=int_or_list,
+                    help='bottleneck width, or 4 comma separated ones (default: 1,2,4,4)')
+parser.add_argument('--num-init-features', default=32, type=int,
+                    help='stem output channels (default: 32)')
+parser.add_argument('--num-classes', default=1000, type=int, help='classes (default: 1000)')
+parser.add_argument('--input-dim', default=224, type=int,
+                    help='size of the input dimension (default: 224)')
+parser.add_argument('-b', '--batch-size', default=1, type=int, metavar='N', help='batch size (default: 1)')
+parser.add_argument('--optimize', action='store_true', help='analyze the optimize_for_inference model')
+parser.add_argument('--peak-gflops', default=0, type=float,
+                    help='peak FP32 GFLOP/s of the machine (default: measured with a GEMM)')
+parser.add_argument('--peak-gbs', default=0, type=float,
+                    help='peak memory bandwidth in GB/s (default: measured with a large copy)')
+parser.add_argument('--measure', action='store_true',
+                    help='time the layers with LayerProfiler and compare with the model')
+parser.add_argument('--iters', default=20, type=int, metavar='N',
+                    help='timed iterations of --measure (default: 20)')
+parser.add_argument('--csv', default='', type=str, metavar='PATH', help='write the per-layer table as CSV')
+
+
+def _bytes(t):
+    return t.numel() * t.element_size()
+
+
+class LiveMemory(object):
+    """Bytes of the tensors seen so far that are still alive, and their peak"""
+    def __init__(self):
+        self.live = 0
+        self.peak = 0
+        self.seen = set()
+
+    def track(self, t):
+        key = t.data_ptr()
+        if key in self.seen:
+            # in-place ops and views hand back memory that is already counted
+            return
+        self.seen.add(key)
+        self.live += _bytes(t)
+        self.peak = max(self.peak, self.live)
+        weakref.finalize(t, self._release, key, _bytes(t))
+
+    def _release(self, key, size):
+        self.seen.discard(key)
+        self.live -= size
+
+
+def leaf_cost(m, input, output):
+    """(MACs, bytes read and written) of one call of a leaf module"""
+    x = input[0]
+    if isinstance(m, (QuantStub, DeQuantStub, nn.Identity)):
+        # identities outside of quantization, and the norm/relu that --optimize folded away
+        return 0, 0
+    traffic = _bytes(x) + _bytes(output) + \
+        sum(_bytes(t) for t in list(m.parameters(recurse=False)) + list(m.buffers(recurse=False)))
+    if isinstance(m, nn.Conv2d):
+        macs = output.numel() * (m.in_channels // m.groups) * m.kernel_size[0] * m.kernel_size[1]
+    elif isinstance(m, nn.Linear):
+        macs = output.numel() * m.in_features
+    elif isinstance(m, _GlobalPoolLinear):
+        macs = x.size(0) * m.weight.numel()
+    else:
+        macs = 0
+    return macs, traffic
+
+
+def analyze(model, input):
+    """OrderedDict {layer: stats} in execution order, concatenations included, and the peak live bytes"""
+    rows = OrderedDict()
+    memory = LiveMemory()
+    handles = []
+
+    def row(name):
+        if name not in rows:
+            rows[name] = {'layer': name, 'macs': 0, 'params': 0, 'output_bytes': 0, 'traffic_bytes': 0,
+                          'concat_bytes': 0}
+        return rows[name]
+
+    def leaf_hook(name):
+        def hook(m, input, output):
+            macs, traffic = leaf_cost(m, input, output)
+            r = row(name)
+            r['macs'] += macs
+            r['traffic_bytes'] += traffic
+            memory.track(output)
+        return hook
+
+    def unit_hook(name):
+        def hook(m, input, output):
+            r = row(name)
+            r['output_bytes'] = _bytes(output)
+            r['params'] = sum(p.numel() for p in m.parameters())
+        return hook
+
+    for name, unit in layers(model):
+        handles.append(unit.register_forward_hook(unit_hook(name)))
+        for m in unit.modules():
+            if not list(m.children()):
+                handles.append(m.register_forward_hook(leaf_hook(name)))
+
+    # the concatenations are calls to f_cat.cat, not modules: wrap them on the instance
+    patched = []
+    for name, m in model.named_modules():
+        if isinstance(m, (_DenseLayer, _StemBlock)):
+            def cat(tensors, dim=0, _cat=m.f_cat.cat, _name=name + '.cat'):
+                out = _cat(tensors, dim)
+                r = row(_name)
+                r['output_bytes'] = _bytes(out)
+                # every input is read once and the output written once
+                r['concat_bytes'] = r['traffic_bytes'] = sum(_bytes(t) for t in tensors) + _bytes(out)
+                memory.track(out)
+                return out
+            m.f_cat.cat = cat
+            patched.append(m.f_cat)
+
+    try:
+        memory.track(input)
+        with torch.no_grad():
+            model(input)
+    finally:
+        for h in handles:
+            h.remove()
+        for f in patched:
+            del f.cat
+
+    return rows, memory.peak
+
+
+def training_activation_bytes(model, input):
+    """Bytes autograd keeps for backward after one training forward, parameters excluded"""
+    params = set(p.data_ptr() for p in model.parameters())
+    saved = {}
+
+    def pack(t):
+        if t.data_ptr() not in params:
+            saved[t.data_ptr()] = max(saved.get(t.data_ptr(), 0), _bytes(t))
+        return t
+
+    model.train()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        output = model(input)
+    model.eval()
+    return sum(saved.values()) + _bytes(output)
+
+
+def adjusted_layers(model):
+    """(layer, input channels, nominal inter_channel, actual) of the dense layers capped at half their input"""
+    config = model.config
+    widths = config['bottleneck_width'] if isinstance(config['bottleneck_width'], list) \
+        else [config['bottleneck_width']] * 4
+    adjusted = []
+    blocks = [(name, m) for name, m in model.features.named_children() if isinstance(m, _DenseBlock)]
+    for (block_name, block), width in zip(blocks, widths):
+        for name, layer in block.named_children():
+            nominal = int(layer.growth_rate * width / 4) * 4
+            if layer.inter_channel != nominal:
+                adjusted.append(('{}.{}'.format(block_name, name), layer.branch1a.conv.in_channels,
+                                 nominal, layer.inter_channel))
+    return adjusted
+
+
+def measure_peak(size=2048, copy_mb=256):
+    """(GFLOP/s of an FP32 GEMM, GB/s of a large copy) with the current thread count"""
+    a, b = torch.randn(size, size), torch.randn(size, size)
+    torch.mm(a, b)
+    t0 = time.perf_counter()
+    for _ in range(5):
+        torch.mm(a, b)
+    gflops = 5 * 2 * size ** 3 / (time.perf_counter() - t0) / 1e9
+
+    src = torch.empty(copy_mb * 2 ** 18)
+    dst = torch.empty_like(src)
+    dst.copy_(src)
+    t0 = time.perf_counter()
+    for _ in range(5):
+        dst.copy_(src)
+    gbs = 5 * 2 * _bytes(src) / (time.perf_counter() - t0) / 1e9
+    return gflops, gbs
+
+
+def roofline(rows, gflops, gbs):
+    """Adds FLOPs per byte, the bound and the roofline time to every row"""
+    ridge = gflops / gbs
+    for r in rows.values():
+        flops = 2 * r['macs']
+        r['intensity'] = flops / float(r['traffic_bytes']) if r['traffic_bytes'] else 0.0
+        r['bound'] = 'compute' if r['intensity'] >= ridge else 'memory'
+        r['roofline_ms'] = 1e3 * max(flops / (gflops * 1e9), r['traffic_bytes'] / (gbs * 1e9))
+    return ridge
+
+
+def measured_ms(model, input, iters):
+    """{layer: mean forward ms} from LayerProfiler, and the mean end-to-end ms"""
+    with torch.no_grad():
+        for _ in range(3):
+            model(input)
+        profiler = LayerProfiler(model)
+        t0 = time.perf_counter()
+        for _ in range(iters):
+            model(input)
+            profiler.step()
+        total = (time.perf_counter() - t0) / iters * 1e3
+    profiler.remove()
+    return dict((r['layer'], r['forward_mean_ms']) for r in profiler.summary()), total
+
+
+def main():
+    args = parser.parse_args()
+
+    model = PeleeNet(growth_rate=args.growth_rate, block_config=args.block_config,
+                     num_init_features=args.num_init_features, bottleneck_width=args.bottleneck_width,
+                     num_classes=args.num_classes).eval()
+    adjusted = adjusted_layers(model)
+    input = torch.randn(args.batch_size, 3, args.input_dim, args.input_dim)
+    training_bytes = training_activation_bytes(model, input)
+    if args.optimize:
+        model.optimize_for_inference()
+
+    rows, inference_peak = analyze(model, input)
+    if args.peak_gflops and args.peak_gbs:
+        gflops, gbs, source = args.peak_gflops, args.peak_gbs, 'given'
+    else:
+        gflops, gbs = measure_peak()
+        gflops, gbs, source = args.peak_gflops or gflops, args.peak_gbs or gbs, 'measured'
+    ridge = roofline(rows, gflops, gbs)
+
+    measured, end_to_end = {}, None
+    if args.measure:
+        measured, end_to_end = measured_ms(model, input, args.iters)
+        for r in rows.values():
+            r['measured_ms'] = measured.get(r['layer'], float('nan'))
+
+    print('{:44s} {:>9s} {:>8s} {:>9s} {:>10s} {:>8s} {:>8s} {:>9s}{}'.format(
+          'layer', 'MMACs', 'params', 'out MB', 'traffic MB', 'FLOP/B', 'bound', 'roof ms',
+          ' {:>9s}'.format('meas ms') if args.measure else ''))
+    for r in rows.values():
+        print('{:44s} {:9.2f} {:8d} {:9.3f} {:10.3f} {:8.1f} {:>8s} {:9.3f}{}'.format(
+              r['layer'], r['macs'] / 1e6, r['params'], r['output_bytes'] / 1e6, r['traffic_bytes'] / 1e6,
+              r['intensity'], r['bound'], r['roofline_ms'],
+              ' {:9.3f}'.format(r['measured_ms']) if args.measure else ''))
+
+    macs = sum(r['macs'] for r in rows.values())
+    params = sum(p.numel() for p in model.parameters())
+    traffic = sum(r['traffic_bytes'] for r in rows.values())
+    concat = sum(r['concat_bytes'] for r in rows.values())
+    print('\nbatch {}, {}x{}: {:.1f} MMACs, {:.3f} M parameters, {:.1f} MB traffic of which {:.1f} MB '
+          '({:.1%}) concatenation copies'.format(args.batch_size, args.input_dim, args.input_dim, macs / 1e6,
+                                                  params / 1e6, traffic / 1e6, concat / 1e6, concat / float(traffic)))
+    print('peak live activations: inference {:.1f} MB, training {:.1f} MB saved for backward '
+          '(+ {:.1f} MB weights, gradients and momentum)'.format(
+              inference_peak / 1e6, training_bytes / 1e6, 3 * 4 * params / 1e6))
+    compute = [r for r in rows.values() if r['bound'] == 'compute']
+    print('roofline ({}): {:.1f} GFLOP/s, {:.1f} GB/s, ridge {:.1f} FLOP/B; {} compute-bound and {} memory-bound '
+          'layers, {:.1%} of the roofline time memory-bound'.format(
+              source, gflops, gbs, ridge, len(compute), len(rows) - len(compute),
+              sum(r['roofline_ms'] for r in rows.values() if r['bound'] == 'memory') /
+              max(sum(r['roofline_ms'] for r in rows.values()), 1e-9)))
+    for name, channels, nominal, actual in adjusted:
+        print('inter_channel of {} adjusted from {} to {} ({} input channels)'.format(name, nominal, actual, channels))
+
+    if args.measure:
+        # layers can only beat the roofline if the model overestimates their traffic, e.g.
+        # when the working set stays in cache; far above it means overhead the model ignores
+        timed = [r for r in rows.values() if r['layer'] in measured]
+        roof = sum(r['roofline_ms'] for r in timed)
+        total = sum(r['measured_ms'] for r in timed)
+        print('\nself-check: layers measured {:.3f} ms against {:.3f} ms on the roofline ({:.1%} attained), '
+              '{:.3f} ms end to end'.format(total, roof, roof / total, end_to_end))
+        pairs = np.array([(r['roofline_ms'], r['measured_ms']) for r in timed if r['macs']])
+        if len(pairs) > 1:
+            print('  correlation of roofline and measured time over the conv layers: {:.2f}'.format(
+                  np.corrcoef(pairs[:, 0], pairs[:, 1])[0, 1]))
+        for r in timed:
+            if r['measured_ms'] < 0.9 * r['roofline_ms']:
+                print('  {} ran {:.3f} ms, faster than its {:.3f} ms roofline bound: traffic overestimated '
+                      '(cache-resident data)'.format(r['layer'], r['measured_ms'], r['roofline_ms']))
+
+    if args.csv:
+        with open(args.csv, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=list(next(iter(rows.values())).keys()))
+            writer.writeheader()
+            writer.writerows(rows.values())
+        print("=> wrote '{}'".format(args.csv))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Reproducible PeleeNet inference benchmark on synthetic inputs.
+
+Sweeps batch size, thread count, resolution and precision, and reports
+throughput together with p50/p90/p99 latency. No dataset is needed.
+
+Usage: python benchmark.py [--batch-sizes 1,16,128] [--threads 1,4,28] [--input-dims 224]
+                           [--precisions fp32,bf16,int8] [--optimize] [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import time
+
+import torch
+
+import quantization
+from peleenet import PeleeNet, load_model, memory_formats
+from profiling import percentile
+
+parser = argparse.ArgumentParser(description='PeleeNet inference benchmark')
+parser.add_argument('--batch-sizes', default='1,16,128', type=str,
+                    help='comma separated batch sizes (default: 1,16,128)')
+parser.add_argument('--threads', default='0', type=str,
+                    help='comma separated thread counts, 0 keeps the torch default (default: 0)')
+parser.add_argument('--input-dims', default='224', type=str,
+                    help='comma separated input resolutions (default: 224)')
+parser.add_argument('--precisions', default='fp32', type=str,
+                    help='comma separated precisions among fp32, bf16, int8 (default: fp32)')
+parser.add_argument('--warmup', default=10, type=int, metavar='N',
+                    help='untimed iterations per configuration (default: 10)')
+parser.add_argument('--iters', default=50, type=int, metavar='N',
+                    help='timed iterations per configuration (default: 50)')
+parser.add_argument('--weights', default='', type=str, metavar='PATH',
+                    help='checkpoint or optimized model (default: random weights)')
+parser.add_argument('--optimize', action='store_true', help='benchmark the optimize_for_inference model')
+parser.add_argument('--shared-buffer', action='store_true', help='enable the shared dense block buffer')
+parser.add_argument('--memory-format', default='contiguous', choices=list(memory_formats),
+                    help='memory format of the model and the inputs (default: contiguous)')
+parser.add_argument('--calib-batches', default=4, type=int, metavar='N',
+                    help='synthetic calibration batches for int8 (default: 4)')
+parser.add_argument('--qbackend', default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                    help='quantized kernels for int8 (default: fbgemm)')
+parser.add_argument('--shared-concat-scale', action='store_true',
+                    help='int8 with one scale per concat group (see quantization.share_concat_observers)')
+parser.add_argument('--output', default='', type=str, metavar='PATH', help='write results as JSON')
+
+
+def build_model(args, precision, input_dim):
+    model = load_model(args.weights) if args.weights else PeleeNet()
+    model.eval()
+    for m in model.features.children():
+        if hasattr(m, 'shared_buffer'):
+            m.shared_buffer = args.shared_buffer
+
+    if precision == 'int8':
+        # Synthetic calibration: the scales are meaningless for accuracy but the
+        # kernels, and so the timings, are the real int8 ones.
+        if args.optimize:
+            model.optimize_for_inference(fold_head=False)
+        quantization.quantize(model, (torch.randn(8, 3, input_dim, input_dim) for _ in range(args.calib_batches)),
+                              backend=args.qbackend, shared_concat=args.shared_concat_scale)
+    elif args.optimize:
+        model.optimize_for_inference()
+
+    return model.to(memory_format=memory_formats[args.memory_format])
+
+
+def measure(model, input, precision, warmup, iters):
+    latencies = []
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+        for i in range(warmup + iters):
+            t0 = time.perf_counter()
+            model(input)
+            if i >= warmup:
+                latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def main():
+    args = parser.parse_args()
+
+    default_threads = torch.get_num_threads()
+    results = []
+    for precision in args.precisions.split(','):
+        for input_dim in [int(v) for v in args.input_dims.split(',')]:
+            model = build_model(args, precision, input_dim)
+            for threads in [int(v) for v in args.threads.split(',')]:
+                torch.set_num_threads(threads if threads > 0 else default_threads)
+                for batch_size in [int(v) for v in args.batch_sizes.split(',')]:
+                    input = torch.randn(batch_size, 3, input_dim, input_dim).contiguous(
+                        memory_format=memory_formats[args.memory_format])
+                    latencies = measure(model, input, precision, args.warmup, args.iters)
+                    result = {
+                        'precision': precision,
+                        'input_dim': input_dim,
+                        'threads': torch.get_num_threads(),
+                        'batch_size': batch_size,
+                        'throughput': batch_size * len(latencies) / sum(latencies),
+                        'latency_ms': dict((k, 1e3 * percentile(latencies, p))
+                                           for k, p in [('p50', 50), ('p90', 90), ('p99', 99)]),
+                    }
+                    results.append(result)
+                    print('{precision:>4s} {input_dim:4d}px {threads:3d} threads batch {batch_size:4d}: '
+                          '{throughput:9.1f} images/s  p50 {p50:8.2f} ms  p90 {p90:8.2f} ms  p99 {p99:8.2f} ms'
+                          .format(p50=result['latency_ms']['p50'], p90=result['latency_ms']['p90'],
+                                  p99=result['latency_ms']['p99'], **result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'environment': {
+                    'torch': torch.__version__,
+                    'python': platform.python_version(),
+                    'processor': platform.processor(),
+                    'cpus': os.cpu_count(),
+                    'default_threads': default_threads,
+                },
+                'config': vars(args),
+                'results': results,
+            }, f, indent=2)
+        print("=> wrote '{}'".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Peak memory and step time of PeleeNet training with and without dense block checkpointing.
+
+Every configuration runs in its own process so that peak RSS is not shared.
+
+Usage: python -m benchmarks.checkpointing [--batch-size 128] [--configs none,3,3+4,1+2+3+4]
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+import torch.nn as nn
+
+from peleenet import PeleeNet
+
+parser = argparse.ArgumentParser(description='PeleeNet activation checkpointing benchmark')
+parser.add_argument('-b', '--batch-size', default=128, type=int, help='mini-batch size (default: 128)')
+parser.add_argument('--input-dim', default=224, type=int,
+                    help='size of the input dimension (default: 224)')
+parser.add_argument('--configs', default='none,3,3+4,1+2+3+4', type=str,
+                    help='comma separated sets of checkpointed blocks, "+" joined (default: none,3,3+4,1+2+3+4)')
+parser.add_argument('--warmup', default=2, type=int, help='warmup steps (default: 2)')
+parser.add_argument('--iters', default=5, type=int, help='timed steps (default: 5)')
+
+
+def run(config, args, results):
+    blocks = [] if config == 'none' else [int(b) for b in config.split('+')]
+    model = PeleeNet(checkpoint_blocks=blocks)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), 0.1, momentum=0.9)
+    input = torch.randn(args.batch_size, 3, args.input_dim, args.input_dim)
+    target = torch.randint(0, 1000, (args.batch_size,))
+
+    # ru_maxrss is in kB on Linux
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for i in range(args.warmup + args.iters):
+        t0 = time.perf_counter()
+        loss = criterion(model(input), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if i >= args.warmup:
+            times.append(time.perf_counter() - t0)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    results[config] = ((peak - base) / 1024.0, sum(times) / len(times))
+
+
+def main():
+    args = parser.parse_args()
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Manager().dict()
+
+    for config in args.configs.split(','):
+        p = ctx.Process(target=run, args=(config, args, results))
+        p.start()
+        p.join()
+
+    print('batch {}, {}x{}'.format(args.batch_size, args.input_dim, args.input_dim))
+    base_mem, base_time = results.get('none', (None, None))
+    for config in args.configs.split(','):
+        if config not in results:
+            print('  {:10s} failed'.format(config))
+            continue
+        mem, step = results[config]
+        line = '  {:10s} peak +{:8.0f} MB   step {:.3f} s'.format(config, mem, step)
+        if base_mem:
+            line += '   ({:.2f}x memory, {:.2f}x time)'.format(mem / base_mem, step / base_time)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
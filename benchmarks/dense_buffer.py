@@ -0,0 +1,99 @@
+"""Compare the concatenating dense blocks with the shared-buffer ones.
+
+Usage: python -m benchmarks.dense_buffer [--batch-sizes 1,128] [--input-dim 224]
+"""
+import argparse
+import time
+
+import torch
+
+from peleenet import PeleeNet, _DenseBlock
+from profiling import percentile
+
+parser = argparse.ArgumentParser(description='PeleeNet dense block buffer benchmark')
+parser.add_argument('--batch-sizes', default='1,128', type=str,
+                    help='comma separated batch sizes (default: 1,128)')
+parser.add_argument('--input-dim', default=224, type=int,
+                    help='size of the input dimension (default: 224)')
+parser.add_argument('--warmup', default=5, type=int, help='warmup iterations (default: 5)')
+parser.add_argument('--iters', default=20, type=int, help='timed iterations (default: 20)')
+parser.add_argument('--channels-last', action='store_true', help='run in NHWC')
+
+
+def block_traffic(model, batch_size, input_dim, elem_size=4):
+    """Bytes moved by concatenation, per dense block, for both execution modes."""
+    sizes = {}
+
+    def record(module, input, output):
+        sizes[module] = input[0].size()
+
+    hooks = [m.register_forward_hook(record) for m in model.modules() if isinstance(m, _DenseBlock)]
+    with torch.no_grad():
+        model(torch.randn(1, 3, input_dim, input_dim))
+    for h in hooks:
+        h.remove()
+
+    rows = []
+    for name, m in model.features.named_children():
+        if m not in sizes:
+            continue
+        pixels = batch_size * sizes[m][2] * sizes[m][3]
+        c = m.num_input_features
+        concat = 0
+        shared = 2 * c
+        for layer in m.children():
+            c += 2 * layer.growth_rate
+            # every concat reads and writes the full output width, the shared
+            # buffer only writes the input once and each layer's new channels
+            concat += 2 * c
+            shared += 2 * 2 * layer.growth_rate
+        rows.append((name, concat * pixels * elem_size, shared * pixels * elem_size))
+    return rows
+
+
+def measure(model, input, warmup, iters):
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(input)
+        times = []
+        for _ in range(iters):
+            t0 = time.perf_counter()
+            model(input)
+            times.append(time.perf_counter() - t0)
+    return percentile(times, 50)
+
+
+def main():
+    args = parser.parse_args()
+
+    baseline = PeleeNet().eval()
+    shared = PeleeNet(shared_buffer=True).eval()
+    shared.load_state_dict(baseline.state_dict())
+    if args.channels_last:
+        baseline = baseline.to(memory_format=torch.channels_last)
+        shared = shared.to(memory_format=torch.channels_last)
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        input = torch.randn(batch_size, 3, args.input_dim, args.input_dim)
+        if args.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+
+        with torch.no_grad():
+            diff = (baseline(input) - shared(input)).abs().max().item()
+
+        print('batch {}: max abs diff {:.3e}'.format(batch_size, diff))
+        total_concat = total_shared = 0
+        for name, concat, buffered in block_traffic(baseline, batch_size, args.input_dim):
+            total_concat += concat
+            total_shared += buffered
+            print('  {:12s} concat {:9.1f} MB   shared {:9.1f} MB'.format(name, concat / 1e6, buffered / 1e6))
+        print('  {:12s} concat {:9.1f} MB   shared {:9.1f} MB'.format('total', total_concat / 1e6, total_shared / 1e6))
+
+        t_concat = measure(baseline, input, args.warmup, args.iters)
+        t_shared = measure(shared, input, args.warmup, args.iters)
+        print('  latency: concat {:.3f} ms, shared {:.3f} ms ({:.2f}x)'.format(
+            t_concat * 1e3, t_shared * 1e3, t_concat / t_shared))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Time spent in int8 concatenation, per-module scales against shared concat scales.
+
+Both models get the same weights and the same synthetic calibration; the
+profiler splits the latency into the concatenation ops and everything else.
+Accuracy needs real calibration data, see main.py --int8 --shared-concat-scale.
+
+Usage: python -m benchmarks.int8_concat [--batch-sizes 1,64] [--input-dim 224] [--channels-last]
+"""
+import argparse
+import copy
+import time
+
+import torch
+
+import quantization
+from peleenet import PeleeNet
+from profiling import percentile
+
+parser = argparse.ArgumentParser(description='PeleeNet int8 concatenation benchmark')
+parser.add_argument('--batch-sizes', default='1,64', type=str,
+                    help='comma separated batch sizes (default: 1,64)')
+parser.add_argument('--input-dim', default=224, type=int,
+                    help='size of the input dimension (default: 224)')
+parser.add_argument('--qbackend', default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                    help='quantized kernels (default: fbgemm)')
+parser.add_argument('--calib-batches', default=4, type=int, help='synthetic calibration batches (default: 4)')
+parser.add_argument('--warmup', default=5, type=int, help='warmup iterations (default: 5)')
+parser.add_argument('--iters', default=20, type=int, help='timed iterations (default: 20)')
+parser.add_argument('--channels-last', action='store_true', help='run in NHWC')
+
+# quantized::cat with per-module scales, the byte concatenation of peleenet._cat otherwise
+CAT_OPS = ['quantized::cat', 'aten::int_repr', 'aten::cat', 'aten::_make_per_tensor_quantized_tensor']
+
+
+def build(model, shared_concat, args):
+    torch.manual_seed(0)
+    batches = [torch.randn(8, 3, args.input_dim, args.input_dim) for _ in range(args.calib_batches)]
+    return quantization.quantize(copy.deepcopy(model), batches, backend=args.qbackend, shared_concat=shared_concat)
+
+
+def measure(model, input, warmup, iters):
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(input)
+        times = []
+        for _ in range(iters):
+            t0 = time.perf_counter()
+            model(input)
+            times.append(time.perf_counter() - t0)
+    return percentile(times, 50)
+
+
+def cat_time(model, input, iters):
+    """(seconds per batch in the concatenation ops, seconds per batch profiled in total)"""
+    with torch.no_grad(), torch.autograd.profiler.profile() as prof:
+        for _ in range(iters):
+            model(input)
+    events = prof.key_averages()
+    cat = sum(e.self_cpu_time_total for e in events if e.key in CAT_OPS)
+    total = sum(e.self_cpu_time_total for e in events)
+    return cat / 1e6 / iters, total / 1e6 / iters
+
+
+def main():
+    args = parser.parse_args()
+
+    model = PeleeNet().eval()
+    models = [('per-module scales', build(model, False, args)),
+              ('shared concat scales', build(model, True, args))]
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        input = torch.randn(batch_size, 3, args.input_dim, args.input_dim)
+        if args.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+
+        print('batch {}:'.format(batch_size))
+        latencies = []
+        for name, m in models:
+            latency = measure(m, input, args.warmup, args.iters)
+            cat, total = cat_time(m, input, args.iters)
+            latencies.append(latency)
+            print('  {:22s} latency {:9.3f} ms, concatenation {:8.3f} ms ({:5.1%} of op time)'.format(
+                name, latency * 1e3, cat * 1e3, cat / total))
+        print('  speedup {:.2f}x'.format(latencies[0] / latencies[1]))
+
+
+if __name__ == '__main__':
+    main()
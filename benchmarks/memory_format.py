@@ -0,0 +1,100 @@
+"""Compare NCHW and NHWC (channels_last) execution of PeleeNet on CPU.
+
+Usage: python -m benchmarks.memory_format [--batch-sizes 1,128] [--optimize] [--train]
+"""
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from peleenet import PeleeNet
+from profiling import percentile
+
+parser = argparse.ArgumentParser(description='PeleeNet memory format benchmark')
+parser.add_argument('--batch-sizes', default='1,128', type=str,
+                    help='comma separated batch sizes (default: 1,128)')
+parser.add_argument('--input-dim', default=224, type=int,
+                    help='size of the input dimension (default: 224)')
+parser.add_argument('--warmup', default=5, type=int, help='warmup iterations (default: 5)')
+parser.add_argument('--iters', default=20, type=int, help='timed iterations (default: 20)')
+parser.add_argument('--optimize', action='store_true', help='benchmark the optimize_for_inference model')
+parser.add_argument('--train', action='store_true', help='time forward and backward instead of inference')
+
+
+def non_nhwc_layers(model, input):
+    """Names of the modules whose output is not laid out as NHWC"""
+    names = []
+
+    def check(name):
+        def hook(module, input, output):
+            # channel slices of an NHWC buffer keep unit channel stride
+            if output.dim() == 4 and not output.is_contiguous(memory_format=torch.channels_last) \
+                    and output.stride(1) != 1:
+                names.append(name)
+        return hook
+
+    hooks = [m.register_forward_hook(check(name)) for name, m in model.features.named_modules() if name]
+    with torch.no_grad():
+        model(input)
+    for h in hooks:
+        h.remove()
+    return names
+
+
+def measure(model, input, warmup, iters, train):
+    criterion = nn.CrossEntropyLoss()
+    target = torch.zeros(input.size(0), dtype=torch.long)
+
+    def step():
+        if train:
+            model.zero_grad()
+            criterion(model(input), target).backward()
+        else:
+            with torch.no_grad():
+                model(input)
+
+    for _ in range(warmup):
+        step()
+    times = []
+    for _ in range(iters):
+        t0 = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - t0)
+    return percentile(times, 50)
+
+
+def main():
+    args = parser.parse_args()
+
+    state_dict = PeleeNet().state_dict()
+    models = {}
+    for name, memory_format in [('nchw', torch.contiguous_format), ('nhwc', torch.channels_last)]:
+        model = PeleeNet()
+        model.load_state_dict(state_dict)
+        if args.optimize:
+            model.optimize_for_inference()
+        model.train(args.train)
+        models[name] = (model.to(memory_format=memory_format), memory_format)
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        input = torch.randn(batch_size, 3, args.input_dim, args.input_dim)
+        results = {}
+        for name, (model, memory_format) in models.items():
+            x = input.contiguous(memory_format=memory_format)
+            t = measure(model, x, args.warmup, args.iters, args.train)
+            results[name] = batch_size / t
+            print('batch {:4d} {}: {:.3f} ms, {:.1f} images/s'.format(batch_size, name, t * 1e3, batch_size / t))
+        print('batch {:4d} nhwc speedup: {:.2f}x'.format(batch_size, results['nhwc'] / results['nchw']))
+
+    model, memory_format = models['nhwc']
+    names = non_nhwc_layers(model.eval(), torch.randn(1, 3, args.input_dim, args.input_dim).contiguous(
+        memory_format=memory_format))
+    if names:
+        print('layers falling back to NCHW: ' + ', '.join(names))
+    else:
+        print('all layers stay in NHWC')
+
+
+if __name__ == '__main__':
+    main()
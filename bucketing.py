@@ -0,0 +1,182 @@
+"""Batched PeleeNet inference over images of mixed sizes.
+
+Images are grouped into a small set of resolution buckets and every bucket runs
+as its own batch, so nothing is upscaled to one fixed --input-dim. Each bucket
+keeps its own warmed-up (optionally TorchScript-compiled) model and a
+preallocated input batch, which avoids per-shape recompilation and allocator
+churn.
+
+Usage: python bucketing.py --weights checkpoint.pth.tar --buckets 224x224,192x256,256x192 img1.jpg ...
+"""
+import argparse
+import math
+import os
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from PIL import Image
+
+import compiled
+from peleenet import load_model
+
+parser = argparse.ArgumentParser(description='PeleeNet bucketed inference')
+parser.add_argument('images', nargs='+', metavar='IMAGE', help='images to classify')
+parser.add_argument('--weights', required=True, type=str, metavar='PATH',
+                    help='main.py checkpoint or optimized model')
+parser.add_argument('--buckets', default='224x224,192x256,256x192', type=str,
+                    help='comma separated HxW buckets (default: 224x224,192x256,256x192)')
+parser.add_argument('--mode', default='resize', choices=['resize', 'pad'],
+                    help='fit images to their bucket by resizing or by aspect-preserving resize and padding')
+parser.add_argument('-b', '--batch-size', default=32, type=int, metavar='N',
+                    help='maximum batch size per bucket (default: 32)')
+parser.add_argument('--topk', default=5, type=int, help='number of classes to report (default: 5)')
+parser.add_argument('--jit', action='store_true', help='compile one TorchScript model per bucket')
+parser.add_argument('--jit-cache', default='.jit_cache', type=str, metavar='DIR',
+                    help='directory of compiled models (default: .jit_cache)')
+
+
+def parse_buckets(text):
+    return [tuple(int(v) for v in b.split('x')) for b in text.split(',')]
+
+
+class ModelInput(object):
+    """Turns a resized PIL image into the input of a model.
+
+    That is the normalized float image, or for a model saved after
+    fold_normalization the uint8 pixels, CHW or with channels_last HWC.
+
+    Args:
+        input_norm (dict) - the model's config['input_norm'], or the one recorded with a
+          compiled artifact (compiled.load_artifact); None for float input
+    """
+    def __init__(self, input_norm=None):
+        self.uint8 = input_norm is not None
+        self.channels_last = self.uint8 and input_norm['channels_last']
+        self.dtype = torch.uint8 if self.uint8 else torch.float32
+        if self.uint8:
+            self.transform = transforms.PILToTensor()
+            # the pixel the model pads with, the zero of the normalized image
+            self.fill = tuple(int(round(255 * v)) for v in input_norm['mean'])
+        else:
+            self.transform = transforms.Compose([
+                transforms.ToTensor(),
+                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            ])
+
+    def shape(self, height, width):
+        return (height, width, 3) if self.channels_last else (3, height, width)
+
+    def __call__(self, image):
+        x = self.transform(image)
+        return x.permute(1, 2, 0) if self.channels_last else x
+
+
+def assign_bucket(buckets, height, width):
+    """The bucket closest in aspect ratio to a height x width image.
+
+    Among equally close buckets, the largest one the image covers, so it is only
+    ever downscaled; an image smaller than all of them gets the smallest one.
+    """
+    def distance(b):
+        return abs(math.log((float(width) / height) / (float(b[1]) / b[0])))
+    best = min(distance(b) for b in buckets)
+    candidates = sorted((b for b in buckets if distance(b) - best < 1e-6), key=lambda b: b[0] * b[1])
+    fitting = [b for b in candidates if b[0] <= height and b[1] <= width]
+    return fitting[-1] if fitting else candidates[0]
+
+
+class BucketedPredictor(object):
+    """Groups images by resolution bucket and runs one batch per bucket.
+
+    Args:
+        model (nn.Module) - eval-mode PeleeNet (plain, optimized or quantized)
+        buckets (list of (height, width)) - input resolutions to serve
+        mode (str) - 'resize' stretches to the bucket, 'pad' keeps the aspect ratio
+          and pads with the mean pixel (zero after normalization)
+        max_batch_size (int) - largest batch run per bucket
+        compile (bool) - trace and freeze a model per bucket
+        checkpoint (str) - checkpoint file keying the compiled-model cache
+    """
+    def __init__(self, model, buckets, mode='resize', max_batch_size=32, compile=False,
+                 checkpoint=None, cache_dir='.jit_cache'):
+        self.buckets = sorted(buckets, key=lambda b: b[0] * b[1])
+        self.mode = mode
+        self.max_batch_size = max_batch_size
+        self.to_input = ModelInput(model.config.get('input_norm'))
+
+        model.eval()
+        self.models = {}
+        self.inputs = {}
+        for h, w in self.buckets:
+            example = torch.zeros((1,) + self.to_input.shape(h, w), dtype=self.to_input.dtype)
+            if compile and checkpoint:
+                key = compiled.cache_key(checkpoint, '{}x{}'.format(h, w))
+                self.models[(h, w)], _ = compiled.load_or_compile(lambda: model, example, key, cache_dir)
+            elif compile:
+                self.models[(h, w)] = compiled.warmup(compiled.compile_model(model, example), example)
+            else:
+                self.models[(h, w)] = compiled.warmup(model, example)
+            self.inputs[(h, w)] = torch.empty((max_batch_size,) + self.to_input.shape(h, w), dtype=self.to_input.dtype)
+
+    def assign(self, height, width):
+        return assign_bucket(self.buckets, height, width)
+
+    def preprocess(self, image, bucket):
+        h, w = bucket
+        if self.mode == 'resize':
+            return self.to_input(image.resize((w, h), Image.BILINEAR))
+
+        scale = min(float(h) / image.height, float(w) / image.width)
+        nh = max(1, min(h, int(round(image.height * scale))))
+        nw = max(1, min(w, int(round(image.width * scale))))
+        image = image.resize((nw, nh), Image.BILINEAR)
+        top, left = (h - nh) // 2, (w - nw) // 2
+        if self.to_input.uint8:
+            canvas = Image.new('RGB', (w, h), self.to_input.fill)
+            canvas.paste(image, (left, top))
+            return self.to_input(canvas)
+        return F.pad(self.to_input(image), (left, w - nw - left, top, h - nh - top))
+
+    def predict(self, images, topk=5):
+        """Returns (probabilities, classes) of the topk classes per image, in input order"""
+        groups = {}
+        for i, image in enumerate(images):
+            image = image.convert('RGB')
+            bucket = self.assign(image.height, image.width)
+            groups.setdefault(bucket, []).append((i, image))
+
+        results = [None] * len(images)
+        with torch.no_grad():
+            for bucket, items in groups.items():
+                for start in range(0, len(items), self.max_batch_size):
+                    chunk = items[start:start + self.max_batch_size]
+                    input = self.inputs[bucket][:len(chunk)]
+                    for j, (_, image) in enumerate(chunk):
+                        input[j].copy_(self.preprocess(image, bucket))
+                    prob = F.softmax(self.models[bucket](input), dim=1)
+                    values, classes = prob.topk(topk, 1)
+                    for j, (i, _) in enumerate(chunk):
+                        results[i] = (values[j].tolist(), classes[j].tolist())
+
+        return results
+
+
+def main():
+    args = parser.parse_args()
+
+    model = load_model(args.weights)
+    predictor = BucketedPredictor(model, parse_buckets(args.buckets), mode=args.mode,
+                                  max_batch_size=args.batch_size, compile=args.jit,
+                                  checkpoint=args.weights, cache_dir=args.jit_cache)
+
+    images = [Image.open(f) for f in args.images]
+    for filename, image, (probs, classes) in zip(args.images, images, predictor.predict(images, args.topk)):
+        print('{} ({}x{} -> {}x{}): {}'.format(
+            os.path.basename(filename), image.height, image.width,
+            *predictor.assign(image.height, image.width),
+            ', '.join('{}:{:.3f}'.format(c, p) for c, p in zip(classes, probs))))
+
+
+if __name__ == '__main__':
+    main()
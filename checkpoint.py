@@ -0,0 +1,126 @@
+"""Checkpoints written on a background thread.
+
+The training thread only pays for copying the state to CPU memory; torch.save,
+fsync and the renames happen while the next epoch runs. Every epoch goes to its
+own file, written under a temporary name and renamed into place, so a crash
+never leaves a truncated checkpoint. checkpoint.pth.tar and model_best.pth.tar
+are hard links to the latest and the best epoch file (copies where the file
+system has no hard links). Of the epoch files it wrote, a checkpointer keeps
+the last `keep`; files of earlier runs in the directory are left alone.
+
+Layout:  DIR/checkpoint-epochNNN.pth.tar, DIR/checkpoint.pth.tar, DIR/model_best.pth.tar
+"""
+import os
+import queue
+import shutil
+import threading
+
+import torch
+
+LATEST = 'checkpoint.pth.tar'
+BEST = 'model_best.pth.tar'
+
+
+def snapshot(state):
+    """Copy of state with every tensor cloned to CPU, safe to read while training goes on"""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _link(src, dst):
+    """Points dst at the contents of src atomically, by hard link or else by copy"""
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class AsyncCheckpointer(object):
+    """Saves checkpoints on a background thread.
+
+    Args:
+        directory (str) - where the checkpoints go, created if missing
+        keep (int) - epoch files to keep, 0 keeps all of them
+    """
+    def __init__(self, directory='.', keep=1):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        # one write in flight and one waiting: a slow disk holds back training
+        # instead of piling up snapshots in memory
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        # epochs written by this checkpointer, oldest first, only touched by the writer thread
+        self._written = []
+        self._thread = threading.Thread(target=self._run, name='checkpointer', daemon=True)
+        self._thread.start()
+
+    def filename(self, epoch):
+        return os.path.join(self.directory, 'checkpoint-epoch{:03d}.pth.tar'.format(epoch))
+
+    def save(self, state, epoch, is_best):
+        """Snapshots state and returns, the file is written in the background"""
+        self._raise()
+        self._queue.put((snapshot(state), epoch, is_best))
+
+    def close(self):
+        """Waits for the pending writes"""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('writing a checkpoint failed: {}'.format(error))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, state, epoch, is_best):
+        filename = self.filename(epoch)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+
+        _link(filename, os.path.join(self.directory, LATEST))
+        if is_best:
+            _link(filename, os.path.join(self.directory, BEST))
+        _fsync_dir(self.directory)
+
+        if epoch not in self._written:
+            self._written.append(epoch)
+        if self.keep > 0:
+            # by write order, so higher epochs left by an earlier run never push out this
+            # one; the links keep the latest and the best epoch alive whatever is removed
+            while len(self._written) > self.keep:
+                old = self.filename(self._written.pop(0))
+                if os.path.exists(old):
+                    os.remove(old)
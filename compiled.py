@@ -0,0 +1,99 @@
+"""TorchScript compilation of PeleeNet with an on-disk cache of frozen models.
+
+A compiled model is keyed by everything that changes the graph or its weights:
+the checkpoint contents, the input resolution, the dtype and the quantization
+config. Later runs (and serving processes) load the artifact directly instead
+of rebuilding, re-fusing and re-tuning the eager model.
+"""
+import hashlib
+import json
+import os
+
+import torch
+
+# the fold_normalization config of the model, JSON null for float input
+INPUT_NORM_FILE = 'input_norm.json'
+
+
+def file_digest(filename, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(checkpoint, input_dim, dtype='fp32', quant_config=None, **options):
+    """Hash of the checkpoint file, resolution, dtype, quantization config and extra options"""
+    parts = {
+        'checkpoint': file_digest(checkpoint),
+        'input_dim': input_dim,
+        'dtype': dtype,
+        'quant_config': file_digest(quant_config) if quant_config else None,
+        'torch': torch.__version__,
+    }
+    parts.update(options)
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def compile_model(model, example_input, optimize=True):
+    """Traces and freezes model. optimize runs the TorchScript inference passes (FP32 only)."""
+    model.eval()
+    with torch.no_grad():
+        compiled = torch.jit.freeze(torch.jit.trace(model, example_input))
+        if optimize:
+            compiled = torch.jit.optimize_for_inference(compiled)
+    return compiled
+
+
+def warmup(model, example_input, iterations=2):
+    # the profiling executor specializes the graph on the first calls
+    with torch.no_grad():
+        for _ in range(iterations):
+            model(example_input)
+    return model
+
+
+def load(filename, example_input=None):
+    model = torch.jit.load(filename, map_location=torch.device('cpu'))
+    if example_input is not None:
+        warmup(model, example_input)
+    return model
+
+
+def load_artifact(filename):
+    """(model, input_norm) of a compiled artifact.
+
+    Freezing inlines PeleeNet.input_norm, so whether the model takes uint8
+    pixels is recorded next to the graph: input_norm is the fold_normalization
+    config, None for float input.
+    """
+    extra_files = {INPUT_NORM_FILE: ''}
+    model = torch.jit.load(filename, map_location=torch.device('cpu'), _extra_files=extra_files)
+    if not extra_files[INPUT_NORM_FILE]:
+        raise ValueError("'{}' does not record its input format, compile it again".format(filename))
+    return model, json.loads(extra_files[INPUT_NORM_FILE])
+
+
+def load_or_compile(build, example_input, key, cache_dir='.jit_cache', optimize=True):
+    """Returns (compiled model, path), compiling build() only on a cache miss.
+
+    build is only called when there is no artifact for key, so expensive steps
+    (fusing, int8 tuning) belong inside it.
+    """
+    filename = os.path.join(cache_dir, 'peleenet-{}.pt'.format(key))
+    if os.path.isfile(filename):
+        print("=> loading compiled model '{}'".format(filename))
+        return load(filename, example_input), filename
+
+    eager = build()
+    model = compile_model(eager, example_input, optimize=optimize)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    input_norm = getattr(eager, 'config', {}).get('input_norm')
+    torch.jit.save(model, tmp, _extra_files={INPUT_NORM_FILE: json.dumps(input_norm)})
+    os.replace(tmp, filename)
+    print("=> saved compiled model '{}'".format(filename))
+
+    return warmup(model, example_input), filename
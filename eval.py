@@ -19,6 +19,7 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets 
 
 from peleenet import PeleeNet 
+import valcache
 
 
 model_names = [ 'peleenet'] 
@@ -50,6 +51,9 @@ parser.add_argument('--weights', type=str, metavar='PATH', default='caffe/peleen
 
 parser.add_argument('--input-dim', default=224, type=int,
                     help='size of the input dimension (default: 224)')
+parser.add_argument('--val-cache', default='', type=str, metavar='DIR',
+                    help='serve validation batches from a pre-decoded memory-mapped cache, '
+                         'built on first use (see valcache.py)')
 
 best_prec1 = 0
 
@@ -65,20 +69,27 @@ def main():
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                      std=[0.229, 0.224, 0.225])
 
-    val_dataset = datasets.ImageFolder(
-        valdir,
-        transforms.Compose([
-            transforms.Resize(args.input_dim+32),
-            transforms.CenterCrop(args.input_dim),
-            transforms.ToTensor(),
-            normalize,
-        ]))
-
-    val_loader = torch.utils.data.DataLoader(val_dataset,
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
-
-    num_classes = len(val_dataset.classes)
+    if args.val_cache:
+        if not valcache.exists(args.val_cache, args.input_dim):
+            print("=> building validation cache in '{}'".format(args.val_cache))
+            valcache.build(valdir, args.val_cache, args.input_dim, args.workers)
+        val_loader = valcache.MemmapLoader(args.val_cache, args.input_dim, args.batch_size)
+        num_classes = len(val_loader.classes)
+    else:
+        val_dataset = datasets.ImageFolder(
+            valdir,
+            transforms.Compose([
+                transforms.Resize(args.input_dim+32),
+                transforms.CenterCrop(args.input_dim),
+                transforms.ToTensor(),
+                normalize,
+            ]))
+
+        val_loader = torch.utils.data.DataLoader(val_dataset,
+            batch_size=args.batch_size, shuffle=False,
+            num_workers=args.workers, pin_memory=True)
+
+        num_classes = len(val_dataset.classes)
     print('Total classes: ',num_classes)
 
     # create model
@@ -149,7 +160,7 @@ def validate_torch(val_loader, model):
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input, volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
@@ -0,0 +1,208 @@
+"""Multi-process CPU data-parallel launcher, one rank per NUMA node.
+
+Every rank runs main.py in its own process pinned to the physical cores of one
+NUMA node, with its memory bound to that node and OMP_NUM_THREADS set to its
+core count. With --loader-cores K, the last K cores of each rank are set aside
+for its DataLoader workers (main.py pins them there through $LOADER_CPUS).
+The rendezvous is env:// over tcp://MASTER_ADDR:MASTER_PORT, 127.0.0.1 on a
+single node. -b is the batch size of each rank.
+
+Usage: python launch.py [--nproc-per-node N] [--loader-cores K] main.py DIR [main.py args]
+       python launch.py --nnodes 2 --node-rank R --master-addr HOST main.py DIR [main.py args]
+       python launch.py --scaling [--max-ranks N] [-b 64] [--bucket-caps 2,8,25]
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+from peleenet import PeleeNet
+from runner import bind_memory, collect, load_libnuma, node_mask, numa_topology, plan
+
+parser = argparse.ArgumentParser(description='PeleeNet CPU data-parallel launcher')
+parser.add_argument('--nproc-per-node', default=0, type=int, metavar='N',
+                    help='ranks on this machine (default: one per NUMA node)')
+parser.add_argument('--nodes', default='', type=str,
+                    help='comma separated NUMA nodes to use (default: all)')
+parser.add_argument('--loader-cores', default=0, type=int, metavar='K',
+                    help='cores of every rank reserved for its DataLoader workers (default: 0, shared)')
+parser.add_argument('--nnodes', default=1, type=int, metavar='N',
+                    help='machines taking part (default: 1)')
+parser.add_argument('--node-rank', default=0, type=int,
+                    help='index of this machine (default: 0)')
+parser.add_argument('--master-addr', default='127.0.0.1', type=str,
+                    help='address of the machine with node rank 0 (default: 127.0.0.1)')
+parser.add_argument('--master-port', default=29500, type=int,
+                    help='free port on the master (default: 29500)')
+parser.add_argument('--scaling', action='store_true',
+                    help='measure synthetic training throughput and scaling efficiency from 1 to N ranks')
+parser.add_argument('--max-ranks', default=0, type=int, metavar='N',
+                    help='largest world size of --scaling (default: one rank per NUMA node)')
+parser.add_argument('-b', '--batch-size', default=64, type=int, metavar='N',
+                    help='per-rank batch size of --scaling (default: 64)')
+parser.add_argument('--input-dim', default=224, type=int,
+                    help='input size of --scaling (default: 224)')
+parser.add_argument('--steps', default=20, type=int, metavar='N',
+                    help='timed steps of --scaling (default: 20)')
+parser.add_argument('--warmup', default=5, type=int, metavar='N',
+                    help='untimed steps of --scaling (default: 5)')
+parser.add_argument('--bucket-caps', default='25', type=str, metavar='MB',
+                    help='comma separated DDP bucket sizes in MB to compare with --scaling (default: 25)')
+parser.add_argument('script', nargs='?', help='training script, usually main.py')
+parser.add_argument('script_args', nargs=argparse.REMAINDER)
+
+
+def split_cores(cores, loader_cores):
+    """(compute cores, loader cores) of one rank"""
+    if loader_cores <= 0:
+        return cores, []
+    if loader_cores >= len(cores):
+        raise ValueError('{} cores per rank cannot spare {} for loading'.format(len(cores), loader_cores))
+    return cores[:-loader_cores], cores[-loader_cores:]
+
+
+def pinned(node, cores, libnuma):
+    """preexec_fn pinning the child to cores and its memory to node.
+
+    It runs between fork and exec, where a threaded parent leaves locks held:
+    libnuma is loaded and the node mask allocated here, in the parent, and the
+    child only makes the two syscalls, whose settings survive the exec.
+    """
+    mask = node_mask(libnuma, node) if libnuma is not None else None
+
+    def pin():
+        os.sched_setaffinity(0, cores)
+        if mask is not None:
+            libnuma.numa_set_membind(mask)
+    return pin
+
+
+def launch(args, layout):
+    world_size = args.nnodes * len(layout)
+    libnuma = load_libnuma()
+    procs = []
+    for local_rank, (node, cores) in enumerate(layout):
+        rank = args.node_rank * len(layout) + local_rank
+        compute, loader = split_cores(cores, args.loader_cores)
+        env = dict(os.environ, RANK=str(rank), LOCAL_RANK=str(local_rank), WORLD_SIZE=str(world_size),
+                   MASTER_ADDR=args.master_addr, MASTER_PORT=str(args.master_port),
+                   OMP_NUM_THREADS=str(len(compute)))
+        if loader:
+            env['LOADER_CPUS'] = ','.join(str(c) for c in loader)
+        print('=> rank {} on node {}: compute cores {}-{}{}'.format(
+              rank, node, compute[0], compute[-1],
+              ', loader cores {}-{}'.format(loader[0], loader[-1]) if loader else ''))
+        procs.append(subprocess.Popen([sys.executable, '-u', args.script] + args.script_args,
+                                      env=env, preexec_fn=pinned(node, compute, libnuma)))
+
+    # one failed rank would leave the others blocked in a collective
+    status = 0
+    while procs:
+        for p in list(procs):
+            code = p.poll()
+            if code is None:
+                continue
+            procs.remove(p)
+            if code != 0 and status == 0:
+                status = code
+                for other in procs:
+                    other.terminate()
+        time.sleep(0.5)
+    return status
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def synthetic_worker(rank, world_size, node, cores, port, bucket_cap_mb, args, results):
+    os.sched_setaffinity(0, cores)
+    bind_memory(node)
+    torch.set_num_threads(len(cores))
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port),
+                            rank=rank, world_size=world_size)
+
+    torch.manual_seed(0)
+    model = nn.parallel.DistributedDataParallel(PeleeNet(), bucket_cap_mb=bucket_cap_mb)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), 0.1, momentum=0.9)
+    input = torch.randn(args.batch_size, 3, args.input_dim, args.input_dim)
+    target = torch.randint(0, 1000, (args.batch_size,))
+
+    model.train()
+    for i in range(args.warmup + args.steps):
+        if i == args.warmup:
+            dist.barrier()
+            start = time.perf_counter()
+        loss = criterion(model(input), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    if rank == 0:
+        results.put(world_size * args.batch_size * args.steps / elapsed)
+    dist.destroy_process_group()
+
+
+def measure(args, layout, bucket_cap_mb):
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    port = free_port()
+    procs = [ctx.Process(target=synthetic_worker,
+                         args=(rank, len(layout), node, cores, port, bucket_cap_mb, args, results))
+             for rank, (node, cores) in enumerate(layout)]
+    for p in procs:
+        p.start()
+    # a rank that dies leaves the others blocked in a collective and rank 0 never reports
+    throughput = collect(results, procs)
+    for p in procs:
+        p.join()
+    return throughput
+
+
+def scaling(args, topology):
+    """Synthetic DDP training at every world size, efficiency is per core against one rank"""
+    max_ranks = args.max_ranks or len(topology)
+    for bucket_cap_mb in [int(v) for v in args.bucket_caps.split(',')]:
+        print('=> bucket cap {} MB, per-rank batch size {}'.format(bucket_cap_mb, args.batch_size))
+        base = None
+        for ranks in range(1, max_ranks + 1):
+            layout = plan(topology, ranks, 0)
+            cores = sum(len(c) for _, c in layout)
+            throughput = measure(args, layout, bucket_cap_mb)
+            if base is None:
+                base = throughput / cores
+            print('{:3d} ranks, {:3d} cores: {:8.1f} images/s, {:6.1%} scaling efficiency'.format(
+                  ranks, cores, throughput, throughput / (base * cores)))
+
+
+def main():
+    args = parser.parse_args()
+    topology = numa_topology()
+    if args.nodes:
+        topology = dict((n, topology[n]) for n in (int(v) for v in args.nodes.split(',')))
+    print('=> topology: ' + ', '.join('node {}: {} cores'.format(n, len(c)) for n, c in sorted(topology.items())))
+
+    if args.scaling:
+        scaling(args, topology)
+        return
+    if not args.script:
+        parser.error('a training script is required without --scaling')
+    sys.exit(launch(args, plan(topology, args.nproc_per_node, 0)))
+
+
+if __name__ == '__main__':
+    main()
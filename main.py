@@ -1,6 +1,7 @@
 import argparse
+import copy
+import itertools
 import os
-import shutil
 import time
 from datetime import datetime
 import math
@@ -16,10 +17,16 @@ import torch.utils.data.distributed
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 
-from peleenet import PeleeNet
-from profiling import Profiling
+from peleenet import PeleeNet, inference_model_source, load_model, memory_formats, save_inference_model
+from profiling import LayerProfiler
+from checkpoint import AsyncCheckpointer
+import compiled
+import prefetch
+import quantization
+import shards
+import tuning
+import valcache
 # from torch import itt
-import ilit
 
 model_names = [ 'peleenet']
 
@@ -52,70 +59,187 @@ parser.add_argument('--print-freq', '-p', default=10, type=int,
                     metavar='N', help='print frequency (default: 10)')
 parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
+parser.add_argument('--checkpoint-dir', default='.', type=str, metavar='DIR',
+                    help='directory of the checkpoints, written in the background (default: .)')
+parser.add_argument('--keep-checkpoints', default=1, type=int, metavar='N',
+                    help='per-epoch checkpoint files to keep, 0 keeps all (default: 1)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
 parser.add_argument('--pretrained', dest='pretrained', action='store_true',
                     help='use pre-trained model')
 parser.add_argument('--input-dim', default=224, type=int,
                     help='size of the input dimension (default: 224)')
-parser.add_argument('--world-size', default=1, type=int,
-                    help='number of distributed processes')
-parser.add_argument('--dist-url', default='tcp://224.66.41.62:23456', type=str,
-                    help='url used to set up distributed training')
+parser.add_argument('--prefetch', default=2, type=int, metavar='N',
+                    help='batches prepared ahead on a background thread, 0 disables (default: 2)')
+parser.add_argument('--data-format', default='folder', choices=['folder', 'shards'],
+                    help='DIR holds image folders or the output of shards.py (default: folder)')
+parser.add_argument('--val-cache', default='', type=str, metavar='DIR',
+                    help='serve validation batches from a pre-decoded memory-mapped cache, '
+                         'built on first use (see valcache.py)')
+parser.add_argument('--progressive', default='', type=str, metavar='SCHEDULE',
+                    help='progressive-resolution schedule as comma separated EPOCH:DIM[:BATCH] phases, '
+                         'e.g. 0:128,30:160,60:192,90:224; without BATCH the batch size scales with '
+                         '(input-dim / DIM)^2 (default: train at --input-dim throughout)')
+parser.add_argument('--world-size', default=int(os.environ.get('WORLD_SIZE', 1)), type=int,
+                    help='number of distributed processes (default: $WORLD_SIZE or 1)')
+parser.add_argument('--rank', default=int(os.environ.get('RANK', 0)), type=int,
+                    help='rank of this process (default: $RANK or 0)')
+parser.add_argument('--dist-url', default='env://' if 'MASTER_ADDR' in os.environ else 'tcp://127.0.0.1:23456',
+                    type=str, help='url used to set up distributed training '
+                                   '(default: env:// under launch.py, else tcp://127.0.0.1:23456)')
+parser.add_argument('--bucket-cap-mb', default=25, type=int, metavar='MB',
+                    help='DDP gradient bucket size, smaller buckets start all-reducing earlier '
+                         'in backward (default: 25, see launch.py --scaling)')
 parser.add_argument('--dist-backend', default='gloo', type=str,
                     help='distributed backend')
 parser.add_argument('--int8', action='store_true', help='int8 quantization')
+parser.add_argument('--quantizer', default='native', choices=['native', 'ilit'],
+                    help='native: torch.quantization calibration, ilit: accuracy-driven tuning '
+                         'with ./config.yaml (default: native)')
+parser.add_argument('--tune-batches', default=10, type=int, metavar='N',
+                    help='ilit: validation batches cached in memory with their FP32 logits to score the '
+                         'trials on, the head of the shuffled val loader; 0 caches all of it (default: 10)')
+parser.add_argument('--tune-metric', default='agreement', choices=['agreement', 'top1'],
+                    help='ilit: score trials by top-1 agreement with FP32 or by top-1 accuracy (default: agreement)')
+parser.add_argument('--qbackend', default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                    help='quantized kernels, fbgemm for x86, qnnpack for ARM (default: fbgemm)')
+parser.add_argument('--calib-batches', default=10, type=int, metavar='N',
+                    help='validation batches to calibrate the native int8 model on (default: 10)')
+parser.add_argument('--calib-cache', default='', type=str, metavar='PATH',
+                    help='activation statistics of the native calibration, reused when the file exists '
+                         'and was calibrated on the same checkpoint')
+parser.add_argument('--shared-concat-scale', action='store_true',
+                    help='native int8 and QAT: one quantization scale per dense block and for the stem, '
+                         'so the concatenations copy bytes instead of requantizing')
+parser.add_argument('--qat', action='store_true',
+                    help='quantization-aware fine-tuning of the checkpoint, then save the converted int8 model '
+                         'to --int8-weights (default: model_int8.pth.tar in --checkpoint-dir)')
+parser.add_argument('--qat-epochs', default=4, type=int, metavar='N',
+                    help='QAT epochs, BatchNorm statistics freeze halfway and the observers one epoch later '
+                         '(default: 4)')
+parser.add_argument('--qat-lr', default=0.001, type=float, metavar='LR',
+                    help='initial learning rate of QAT, following --lr-policy (default: 0.001)')
+parser.add_argument('--int8-weights', default='', type=str, metavar='PATH',
+                    help='load the native int8 model from PATH if it was made from the same checkpoint, '
+                         'else quantize and save it there')
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                    help='bf16 runs training and validation under CPU autocast and, with --evaluate, '
+                         'stores the weights in bf16 and compares against fp32 (default: fp32)')
 parser.add_argument('--profile', default='none', type=str, help='Profile')
+parser.add_argument('--layer-profile', default='', type=str, metavar='PATH',
+                    help='time every layer forward and backward, print the table and write PATH.json '
+                         '(Chrome trace) and PATH.csv')
+parser.add_argument('--layer-profile-every', default=1, type=int, metavar='N',
+                    help='profile one iteration out of every N (default: 1)')
+parser.add_argument('--shared-buffer', action='store_true',
+                    help='write dense block outputs into one preallocated buffer during inference')
+parser.add_argument('--optimize', action='store_true',
+                    help='rewrite the model for inference before evaluation')
+parser.add_argument('--export', default='', type=str, metavar='PATH',
+                    help='save the model rewritten by --optimize to PATH')
+parser.add_argument('--memory-format', default='contiguous', choices=list(memory_formats),
+                    help='memory format of the model and the input batches (default: contiguous)')
+parser.add_argument('--checkpoint-segments', default='', type=str, metavar='BLOCKS',
+                    help='comma separated dense blocks (1-4) to recompute in backward, '
+                         'trading step time for activation memory (default: none)')
+parser.add_argument('--uint8-input', action='store_true',
+                    help='feed uint8 pixels and fold the normalization into the first conv (evaluation only)')
+parser.add_argument('--jit', action='store_true',
+                    help='evaluate a traced and frozen TorchScript model, cached on disk')
+parser.add_argument('--jit-cache', default='.jit_cache', type=str, metavar='DIR',
+                    help='directory of compiled models (default: .jit_cache)')
 
 best_acc1 = 0
+layer_profiler = None
 
 
 def main():
     global args, best_acc1
     args = parser.parse_args()
     print( 'args:',args)
+    if args.uint8_input and not args.evaluate:
+        parser.error('--uint8-input is an inference option, use it with --evaluate')
+    if (args.int8 or args.qat) and args.precision != 'fp32':
+        parser.error('--int8/--qat and --precision bf16 are exclusive')
+    if args.qat and args.evaluate:
+        parser.error('--qat trains, evaluate its output with --int8 --int8-weights')
+    if args.qat and not args.resume:
+        # fine-tune from checkpoint.pth.tar
+        args.pretrained = True
 
     args.distributed = args.world_size > 1
 
     if args.distributed:
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
-                                world_size=args.world_size)
+                                world_size=args.world_size, rank=args.rank)
 
     # Val data loading
     valdir = os.path.join(args.data, 'val')
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                      std=[0.229, 0.224, 0.225])
 
-    val_dataset = datasets.ImageFolder(
-        valdir,
-        transforms.Compose([
+    if args.val_cache:
+        # one builder per machine, the other ranks wait for it
+        if int(os.environ.get('LOCAL_RANK', 0)) == 0 and not valcache.exists(args.val_cache, args.input_dim):
+            print("=> building validation cache in '{}'".format(args.val_cache))
+            valcache.build(valdir, args.val_cache, args.input_dim, args.workers)
+        if args.distributed:
+            dist.barrier()
+        # the 1280 images of the folder loader, the cache is stored shuffled so they are a random draw
+        val_loader = valcache.MemmapLoader(args.val_cache, args.input_dim, args.batch_size, raw=args.uint8_input,
+                                           rank=dist.get_rank() if args.distributed else 0,
+                                           world_size=args.world_size, num_samples=1280)
+        num_classes = len(val_loader.classes)
+    else:
+        if args.uint8_input:
+            # the model normalizes, workers only hand over the cropped pixels
+            to_tensor = [transforms.PILToTensor()]
+        else:
+            to_tensor = [transforms.ToTensor(), normalize]
+        val_transform = transforms.Compose([
             transforms.Resize(args.input_dim+32),
             transforms.CenterCrop(args.input_dim),
-            transforms.ToTensor(),
-            normalize,
-        ]))
-
-    val_loader = torch.utils.data.DataLoader(val_dataset,
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True,
-        sampler=torch.utils.data.RandomSampler(val_dataset, replacement=True, num_samples=1280))
-
-    num_classes = len(val_dataset.classes)
+        ] + to_tensor)
+
+        if args.data_format == 'shards':
+            val_dataset = shards.ShardDataset(valdir, val_transform, shuffle=False,
+                                              distributed=args.distributed, drop_last=False)
+            val_loader = torch.utils.data.DataLoader(val_dataset,
+                batch_size=args.batch_size, num_workers=args.workers, pin_memory=True,
+                worker_init_fn=pin_loader_worker)
+        else:
+            val_dataset = datasets.ImageFolder(valdir, val_transform)
+            val_sampler = torch.utils.data.RandomSampler(val_dataset, replacement=True, num_samples=1280)
+            if args.distributed:
+                # the same draw on every rank, each validating its own share of it
+                val_sampler = DistributedEvalSampler(torch.utils.data.RandomSampler(
+                    val_dataset, replacement=True, num_samples=1280, generator=torch.Generator().manual_seed(0)))
+            val_loader = torch.utils.data.DataLoader(val_dataset,
+                batch_size=args.batch_size, shuffle=False,
+                num_workers=args.workers, pin_memory=True, worker_init_fn=pin_loader_worker,
+                sampler=val_sampler)
+
+        num_classes = len(val_dataset.classes)
     print('Total classes: ',num_classes)
 
     # create model
     print("=> creating model '{}'".format(args.arch))
+    checkpoint_blocks = [int(b) for b in args.checkpoint_segments.split(',') if b]
     if args.arch == 'peleenet':
-        model = PeleeNet(num_classes=num_classes)
+        model = PeleeNet(num_classes=num_classes, shared_buffer=args.shared_buffer,
+                         checkpoint_blocks=checkpoint_blocks)
     else:
         print("=> unsupported model '{}'. creating PeleeNet by default.".format(args.arch))
-        model = PeleeNet(num_classes=num_classes)
+        model = PeleeNet(num_classes=num_classes, shared_buffer=args.shared_buffer,
+                         checkpoint_blocks=checkpoint_blocks)
+
+    model = model.to(memory_format=memory_formats[args.memory_format])
 
     if args.distributed:
         # model.cuda()
         # DistributedDataParallel will divide and allocate batch_size to all
         # available GPUs if device_ids are not set
-        model = torch.nn.parallel.DistributedDataParallel(model)
+        model = torch.nn.parallel.DistributedDataParallel(model, bucket_cap_mb=args.bucket_cap_mb)
     # else:
     #     # DataParallel will divide and allocate batch_size to all available GPUs
     #     # model = torch.nn.DataParallel(model).cuda()
@@ -142,8 +266,9 @@ def main():
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
     elif args.pretrained:
-        if os.path.isfile('checkpoint.pth.tar'):
-            checkpoint = torch.load('checkpoint.pth.tar', map_location=torch.device('cpu'))
+        if os.path.isfile(os.path.join(args.checkpoint_dir, 'checkpoint.pth.tar')):
+            checkpoint = torch.load(os.path.join(args.checkpoint_dir, 'checkpoint.pth.tar'),
+                                    map_location=torch.device('cpu'))
             model.load_state_dict(checkpoint['state_dict'])
 
             print("=> loaded checkpoint '{}' (epoch {}, acc@1 {})"
@@ -155,78 +280,319 @@ def main():
     # cudnn.benchmark = True
 
 
-    with Profiling(model, os.getpid(), enabled=False):
-        if args.evaluate:
-            model.eval()
-            if args.int8:
-                # print('Before fuse')
-                # print(model)
-                model.fuse()
-                # print('After fuse')
-                # print(model)
-                # model.qconfig = torch.quantization.get_default_qconfig('fbgemm')
-                # # print(model.qconfig)
-                # torch.quantization.prepare(model, inplace=True)
-                # print('validate for converting')
-                # # itt.range_push('validate_convert')
-                # validate(val_loader, model, criterion)
-                # # itt.range_pop()
-                # # itt.range_push('quant_convert')
-                # torch.quantization.convert(model, inplace=True)
-                # # itt.range_pop()
-                tuner = ilit.Tuner('./config.yaml')
-                model = tuner.tune(model, val_loader, eval_dataloader=val_loader)
-            print('main validation')
-            # itt.range_push('main validation')
-            validate(val_loader, model, criterion, profile=args.profile)
-            # itt.range_pop()
+    if args.evaluate:
+        if args.distributed:
+            # no gradients to synchronize, and the inference rewrites work on PeleeNet itself
+            model = model.module
+        checkpoint_file = loaded_checkpoint()
+        # ties the calibration cache and the int8 model to the weights they were made from
+        source = compiled.file_digest(checkpoint_file) if args.int8 and os.path.isfile(checkpoint_file) else None
+        if args.precision != 'fp32':
+            print('fp32 baseline validation')
+            baseline = {}
+            fp32_model = prepare_inference(copy.deepcopy(model), val_loader, criterion, precision='fp32',
+                                           baseline=True)
+            validate(val_loader, fp32_model, criterion, precision='fp32', stats=baseline)
+            del fp32_model
+        if args.jit and os.path.isfile(checkpoint_file):
+            key = compiled.cache_key(checkpoint_file, args.input_dim,
+                                     dtype='int8' if args.int8 else args.precision,
+                                     quant_config='./config.yaml' if args.int8 and args.quantizer == 'ilit'
+                                     else None,
+                                     quantizer=args.quantizer if args.int8 else None,
+                                     qbackend=args.qbackend if args.int8 else None,
+                                     calib_batches=args.calib_batches if args.int8 else None,
+                                     tune=(args.tune_batches, args.tune_metric)
+                                     if args.int8 and args.quantizer == 'ilit' else None,
+                                     shared_concat=args.shared_concat_scale if args.int8 else None,
+                                     optimize=args.optimize, memory_format=args.memory_format,
+                                     shared_buffer=args.shared_buffer, uint8_input=args.uint8_input)
+            example = torch.randint(0, 256, (1, 3, args.input_dim, args.input_dim), dtype=torch.uint8) \
+                if args.uint8_input else torch.randn(1, 3, args.input_dim, args.input_dim)
+            example = example.contiguous(memory_format=memory_formats[args.memory_format])
+            eager = model
+            model, _ = compiled.load_or_compile(lambda: prepare_inference(eager, val_loader, criterion,
+                                                                          source=source),
+                                                example, key, cache_dir=args.jit_cache,
+                                                optimize=not args.int8)
+        else:
+            if args.jit:
+                print("=> no checkpoint to key the compiled model on, running eager")
+            model = prepare_inference(model, val_loader, criterion, source=source)
+        print('main validation')
+        # itt.range_push('main validation')
+        stats = {}
+        start_layer_profile(model)
+        validate(val_loader, model, criterion, profile=args.profile, stats=stats)
+        finish_layer_profile()
+        # itt.range_pop()
+        if args.precision != 'fp32' and is_main_process():
+            print('{} vs fp32: Acc1 {:.3f} ({:+.3f}), {:.1f} images/s ({:.2f}x)'.format(
+                  args.precision, stats['acc1'], stats['acc1'] - baseline['acc1'], stats['images_per_sec'],
+                  stats['images_per_sec'] / baseline['images_per_sec']))
         return
 
     # Training data loading
     traindir = os.path.join(args.data, 'train')
 
-    train_dataset = datasets.ImageFolder(
-        traindir,
-        transforms.Compose([
-            transforms.RandomResizedCrop(args.input_dim),
+    def train_transform(input_dim):
+        return transforms.Compose([
+            transforms.RandomResizedCrop(input_dim),
             transforms.RandomHorizontalFlip(),
             transforms.ToTensor(),
             normalize,
-        ]))
+        ])
 
-    if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
-    else:
+    # QAT fine-tunes at the final resolution
+    phases = parse_progressive('' if args.qat else args.progressive)
+    input_dim, batch_size = phase_at(phases, args.start_epoch)
+
+    if args.data_format == 'shards':
+        # shuffles and splits across ranks and workers by itself
+        train_dataset = shards.ShardDataset(traindir, train_transform(input_dim))
         train_sampler = None
+    else:
+        train_dataset = datasets.ImageFolder(traindir, train_transform(input_dim))
+        if args.distributed:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+        else:
+            train_sampler = None
+
+    def train_loader_for(batch_size):
+        return torch.utils.data.DataLoader(
+            train_dataset, batch_size=batch_size,
+            shuffle=(train_sampler is None and args.data_format == 'folder'),
+            num_workers=args.workers, pin_memory=True, sampler=train_sampler,
+            worker_init_fn=pin_loader_worker)
+
+    train_loader = train_loader_for(batch_size)
 
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler)
 
+    if args.qat:
+        quantization_aware_training(model, train_loader, val_loader, criterion)
+        return
+
+    start_layer_profile(model)
+    checkpointer = AsyncCheckpointer(args.checkpoint_dir, keep=args.keep_checkpoints) \
+        if is_main_process() else None
 
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if phase_at(phases, epoch) != (input_dim, batch_size):
+            # a new phase: rebuild the crop and the loader, the LR schedule is unaffected
+            input_dim, batch_size = phase_at(phases, epoch)
+            train_dataset.transform = train_transform(input_dim)
+            train_loader = train_loader_for(batch_size)
+            if is_main_process():
+                print('=> epoch {}: training at {}x{}, batch size {}'.format(
+                      epoch, input_dim, input_dim, batch_size))
+
+        if train_sampler is not None:
             train_sampler.set_epoch(epoch)
+        elif args.data_format == 'shards':
+            train_dataset.set_epoch(epoch)
 
         # train for one epoch
         train(train_loader, model, criterion, optimizer, epoch)
 
-        # evaluate on validation set
+        # evaluate on validation set, the layer profile covers training only
+        if layer_profiler is not None:
+            layer_profiler.pause()
         acc1 = validate(val_loader, model, criterion)
+        if layer_profiler is not None:
+            layer_profiler.resume()
 
-        # remember best Acc@1 and save checkpoint
+        # remember best Acc@1 and save checkpoint, acc1 is the same on every rank
         is_best = acc1 > best_acc1
         best_acc1 = max(acc1, best_acc1)
-        save_checkpoint({
+        if checkpointer is None:
+            continue
+        checkpointer.save({
             'epoch': epoch + 1,
             'arch': args.arch,
             'state_dict': model.state_dict(),
             'best_acc1': best_acc1,
             'optimizer' : optimizer.state_dict(),
-        }, is_best)
+        }, epoch + 1, is_best)
 
+    if checkpointer is not None:
+        checkpointer.close()
+    finish_layer_profile()
 
-def train(train_loader, model, criterion, optimizer, epoch):
+
+def start_layer_profile(model):
+    global layer_profiler
+    if not args.layer_profile:
+        return
+    if isinstance(model, torch.jit.ScriptModule):
+        print('=> --layer-profile needs an eager model, not profiling the TorchScript one')
+        return
+    layer_profiler = LayerProfiler(model, every=args.layer_profile_every)
+
+
+def finish_layer_profile():
+    global layer_profiler
+    if layer_profiler is None:
+        return
+    layer_profiler.remove()
+    if is_main_process():
+        print(layer_profiler.table())
+        layer_profiler.export_chrome_trace(args.layer_profile + '.json')
+        layer_profiler.export_csv(args.layer_profile + '.csv')
+        print("=> wrote '{0}.json' and '{0}.csv'".format(args.layer_profile))
+    layer_profiler = None
+
+
+def loaded_checkpoint():
+    """The checkpoint file the model weights came from, '' for a freshly initialized model"""
+    return args.resume or (os.path.join(args.checkpoint_dir, 'checkpoint.pth.tar') if args.pretrained else '')
+
+
+def is_main_process():
+    return not args.distributed or dist.get_rank() == 0
+
+
+class DistributedEvalSampler(torch.utils.data.Sampler):
+    """This rank's share of the indices of sampler.
+
+    Unlike DistributedSampler nothing is padded or dropped, so every index is
+    evaluated exactly once across the ranks. sampler must yield the same
+    sequence on all ranks.
+    """
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+
+    def __iter__(self):
+        return itertools.islice(iter(self.sampler), self.rank, None, self.world_size)
+
+    def __len__(self):
+        return (len(self.sampler) - self.rank + self.world_size - 1) // self.world_size
+
+
+def pin_loader_worker(worker_id):
+    """Moves a DataLoader worker to the cores launch.py set aside for loading"""
+    cpus = os.environ.get('LOADER_CPUS')
+    if cpus:
+        os.sched_setaffinity(0, [int(c) for c in cpus.split(',')])
+
+
+def parse_progressive(schedule):
+    """[(start epoch, input dim, batch size)] sorted by epoch, one phase when schedule is empty"""
+    phases = []
+    for phase in [p for p in schedule.split(',') if p]:
+        values = [int(v) for v in phase.split(':')]
+        if len(values) == 2:
+            # keep pixels per batch, and so activation memory, roughly constant
+            batch_size = int(args.batch_size * (float(args.input_dim) / values[1]) ** 2) // 8 * 8
+            values.append(max(batch_size, 8))
+        phases.append(tuple(values))
+    phases.sort()
+    starts = [phase[0] for phase in phases]
+    if len(set(starts)) != len(starts):
+        parser.error('--progressive: more than one phase starts at the same epoch')
+    if not phases or phases[0][0] > 0:
+        phases.insert(0, (0, args.input_dim, args.batch_size))
+    return phases
+
+
+def phase_at(phases, epoch):
+    input_dim, batch_size = phases[0][1:]
+    for start, dim, batch in phases:
+        if start <= epoch:
+            input_dim, batch_size = dim, batch
+    return input_dim, batch_size
+
+
+def prepare_inference(model, val_loader, criterion, precision=None, source=None, baseline=False):
+    """Rewrites model for evaluation as the flags ask.
+
+    source is the compiled.file_digest of the checkpoint model was loaded from,
+    the int8 model and the calibration cache are only reused when it matches.
+    baseline prepares the FP32 reference of a bf16 run, which saves nothing.
+    """
+    precision = precision or args.precision
+    model.eval()
+    if args.uint8_input:
+        model.fold_normalization()
+    if args.optimize:
+        model.optimize_for_inference(fold_head=not args.int8)
+        model = model.to(memory_format=memory_formats[args.memory_format])
+    if precision == 'bf16':
+        model.to_bfloat16()
+    if args.optimize and args.export and not baseline:
+        save_inference_model(model, args.export)
+        print("=> saved optimized model to '{}'".format(args.export))
+    if args.int8 and args.quantizer == 'ilit':
+        import ilit
+        model.fuse()
+        # decode the eval set and run the FP32 model once, not on every trial; every val loader
+        # serves a random draw, so the first batches cover all the classes
+        evaluator = tuning.CachedEvaluator(model, val_loader, num_batches=args.tune_batches or None,
+                                           metric=args.tune_metric,
+                                           criterion=tuning.accuracy_criterion('./config.yaml'),
+                                           memory_format=memory_formats[args.memory_format])
+        tuner = ilit.Tuner('./config.yaml')
+        model = tuner.tune(model, evaluator.loader, eval_func=evaluator)
+        print('=> tuning: {}'.format(evaluator))
+    elif args.int8 and args.int8_weights and os.path.isfile(args.int8_weights) and source is not None \
+            and inference_model_source(args.int8_weights) == source:
+        model = load_model(args.int8_weights)
+        assert (model.input_norm is not None) == args.uint8_input, \
+            "'{}' was saved {} --uint8-input".format(args.int8_weights,
+                                                    'with' if model.input_norm is not None else 'without')
+        print("=> loaded int8 model '{}'".format(args.int8_weights))
+    elif args.int8:
+        if args.int8_weights and os.path.isfile(args.int8_weights):
+            print("=> '{}' was not made from this checkpoint, quantizing again".format(args.int8_weights))
+        batches = quantization.loader_batches(val_loader, args.calib_batches,
+                                              memory_format=memory_formats[args.memory_format])
+        quantization.quantize(model, batches, backend=args.qbackend, cache=args.calib_cache,
+                              shared_concat=args.shared_concat_scale, source=source)
+        if args.int8_weights:
+            save_inference_model(model, args.int8_weights, source=source)
+            print("=> saved int8 model to '{}'".format(args.int8_weights))
+
+    return model
+
+
+def quantization_aware_training(model, train_loader, val_loader, criterion):
+    checkpoint_file = loaded_checkpoint()
+    source = compiled.file_digest(checkpoint_file) if os.path.isfile(checkpoint_file) else None
+    if args.distributed:
+        model = model.module
+    quantization.prepare_qat(model, backend=args.qbackend, shared_concat=args.shared_concat_scale)
+    qat_model = model
+    if args.distributed:
+        qat_model = torch.nn.parallel.DistributedDataParallel(model, bucket_cap_mb=args.bucket_cap_mb)
+    optimizer = torch.optim.SGD(qat_model.parameters(), args.qat_lr,
+                                momentum=args.momentum,
+                                weight_decay=args.weight_decay)
+
+    for epoch in range(args.qat_epochs):
+        if isinstance(train_loader.sampler, torch.utils.data.distributed.DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)
+        elif args.data_format == 'shards':
+            train_loader.dataset.set_epoch(epoch)
+        quantization.qat_freeze(model, epoch, args.qat_epochs)
+
+        train(train_loader, qat_model, criterion, optimizer, epoch, num_epochs=args.qat_epochs, lr=args.qat_lr)
+        # fake-quantized accuracy, close to what the int8 model gets, without fitting the ranges to it
+        with quantization.observers_frozen(model):
+            validate(val_loader, qat_model, criterion)
+
+    model.eval()
+    quantization.convert(model, backend=args.qbackend)
+    if is_main_process():
+        print('int8 validation')
+    validate(val_loader, model, criterion)
+
+    filename = args.int8_weights or os.path.join(args.checkpoint_dir, 'model_int8.pth.tar')
+    if is_main_process():
+        save_inference_model(model, filename, source=source)
+        print("=> saved int8 model to '{}'".format(filename))
+
+
+def train(train_loader, model, criterion, optimizer, epoch, num_epochs=None, lr=None):
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -236,25 +602,28 @@ def train(train_loader, model, criterion, optimizer, epoch):
     # switch to train mode
     model.train()
 
+    loader = prefetched(train_loader)
     end = time.time()
-    for i, (input, target) in enumerate(train_loader):
+    for i, (input, target) in enumerate(loader):
 
         ### Adjust learning rate
-        lr = adjust_learning_rate(optimizer, epoch,  args.epochs, args.lr, iteration=i,
-                                  iterations_per_epoch=len(train_loader),
-                                  method=args.lr_policy)
+        adjust_learning_rate(optimizer, epoch, num_epochs or args.epochs, lr or args.lr, iteration=i,
+                             iterations_per_epoch=len(train_loader),
+                             method=args.lr_policy)
 
 
         # measure data loading time
-        data_time.update(time.time() - end)
+        data_time.update(loader.wait_time if args.prefetch > 0 else time.time() - end)
 
         # target = target.cuda(async=True)
+        input = input.contiguous(memory_format=memory_formats[args.memory_format])
         input_var = torch.autograd.Variable(input)
         target_var = torch.autograd.Variable(target)
 
         # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
+        with autocast(args.precision):
+            output = model(input_var)
+            loss = criterion(output, target_var)
 
         # measure accuracy and record loss
         acc1, acc5 = accuracy(output.data, target, topk=(1, 5))
@@ -265,13 +634,15 @@ def train(train_loader, model, criterion, optimizer, epoch):
         # compute gradient and do SGD step
         optimizer.zero_grad()
         loss.backward()
+        if layer_profiler is not None:
+            layer_profiler.step()
         optimizer.step()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
-        if i % args.print_freq == 0:
+        if i % args.print_freq == 0 and is_main_process():
             print('Epoch: [{0}][{1}/{2}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
@@ -283,19 +654,43 @@ def train(train_loader, model, criterion, optimizer, epoch):
 
 
 
-def validate(val_loader, model, criterion, profile='none'):
+def prefetched(loader, precision=None):
+    if args.prefetch <= 0:
+        return loader
+    # with bf16 the input is converted on the background thread, not by the first conv
+    dtype = torch.bfloat16 if (precision or args.precision) == 'bf16' else None
+    return prefetch.Prefetcher(loader, memory_format=memory_formats[args.memory_format], dtype=dtype,
+                               depth=args.prefetch, pin_memory=True)
+
+
+def autocast(precision):
+    """CPU autocast for bf16, a no-op for fp32.
+
+    Convs and matmuls run in bf16 while the parameters, the BatchNorm running
+    statistics and, see PeleeNet._classify, the classifier stay in FP32.
+    """
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+def validate(val_loader, model, criterion, profile='none', precision=None, stats=None):
     batch_time = AverageMeter()
+    data_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     top5 = AverageMeter()
 
     # switch to evaluate mode
+    model.eval()
 
-    with torch.no_grad():
-        for i, (input, target) in enumerate(val_loader):
+    loader = prefetched(val_loader, precision)
+    end = time.time()
+    with torch.no_grad(), autocast(precision or args.precision):
+        for i, (input, target) in enumerate(loader):
+            data_time.update(loader.wait_time if args.prefetch > 0 else time.time() - end)
             # target = target.cuda(async=True)
             # input_var = torch.autograd.Variable(input)
             # target_var = torch.autograd.Variable(target)
+            input = input.contiguous(memory_format=memory_formats[args.memory_format])
 
             # compute output
             end = time.time()
@@ -309,18 +704,13 @@ def validate(val_loader, model, criterion, profile='none'):
                         os.mkdir('LOGS')
                     prof.export_chrome_trace('LOGS/'+profile+'.json')
             else:
-                num = 0
-                dur_sum = 0
-                for i in range(0, 20):
-                    t0 = time.time()
-                    output = model(input)
-                    if i >= 10:
-                        num += 1
-                        dur_sum += time.time() - t0
+                # accuracy pass only, use benchmark.py for throughput and latency numbers
+                output = model(input)
+                if layer_profiler is not None:
+                    layer_profiler.step()
 
             # measure elapsed time
             batch_time.update(time.time() - end)
-            # end = time.time()
 
             loss = criterion(output, target)
 
@@ -329,6 +719,7 @@ def validate(val_loader, model, criterion, profile='none'):
             losses.update(loss.item(), input.size(0))
             top1.update(acc1[0], input.size(0))
             top5.update(acc5[0], input.size(0))
+            end = time.time()
 
             # if i % args.print_freq == 0:
             #     print('Test: [{0}/{1}]\t'
@@ -339,17 +730,25 @@ def validate(val_loader, model, criterion, profile='none'):
             #            i, len(val_loader), batch_time=batch_time, loss=losses,
             #            top1=top1, top5=top5))
 
-        # print('Time {batch_time.avg:.3f} Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
-        #         .format(batch_time=batch_time, top1=top1, top5=top5))
-        print('time: {:.3f}s, Acc1: {:.3f}, Acc5: {:.3f}'.format(dur_sum/num, top1.avg, top5.avg))
-
-    return top1.avg
+    # per-rank sums, all-reduced when the ranks validated disjoint shares
+    totals = [float(losses.sum), float(top1.sum), float(top5.sum), top1.count, top1.count / batch_time.sum]
+    if args.distributed:
+        totals = torch.tensor(totals, dtype=torch.float64)
+        dist.all_reduce(totals)
+        totals = totals.tolist()
+    loss_sum, top1_sum, top5_sum, count, images_per_sec = totals
+    acc1, acc5 = top1_sum / count, top5_sum / count
 
+    # print('Time {batch_time.avg:.3f} Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
+    #         .format(batch_time=batch_time, top1=top1, top5=top5))
+    if is_main_process():
+        print('time: {:.3f}s/batch ({:.1f} images/s), data wait: {:.3f}s/batch, '
+              'Loss: {:.4f}, Acc1: {:.3f}, Acc5: {:.3f}'.format(
+              batch_time.avg, images_per_sec, data_time.avg, loss_sum / count, acc1, acc5))
 
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, 'model_best.pth.tar')
+    if stats is not None:
+        stats.update(acc1=acc1, acc5=acc5, images_per_sec=images_per_sec)
+    return acc1
 
 
 class AverageMeter(object):
@@ -373,9 +772,10 @@ class AverageMeter(object):
 def adjust_learning_rate(optimizer, epoch, num_epochs, init_lr, iteration=None,
                          iterations_per_epoch=None, method='step'):
     if method == 'cosine':
-        T_total = num_epochs * iterations_per_epoch
-        T_cur = (epoch % num_epochs) * iterations_per_epoch + iteration
-        lr = 0.5 * init_lr * (1 + math.cos(math.pi * T_cur / T_total))
+        # progress in epochs rather than iterations, so the schedule stays continuous
+        # when iterations_per_epoch changes with a progressive-resolution phase
+        T_cur = (epoch % num_epochs) + float(iteration) / iterations_per_epoch
+        lr = 0.5 * init_lr * (1 + math.cos(math.pi * T_cur / num_epochs))
     else:
         lr = init_lr * (0.1 ** (epoch // 30))
 
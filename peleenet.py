@@ -1,11 +1,17 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.nn.intrinsic as nni
+import torch.nn.quantized as nnq
+import torch.utils.checkpoint as cp
 from torch.quantization import QuantStub, DeQuantStub
 from collections import OrderedDict
 
 import math
 
+# --memory-format choices of main.py and benchmark.py
+memory_formats = {'contiguous': torch.contiguous_format, 'channels_last': torch.channels_last}
+
 
 class _DenseLayer(nn.Module):
     def __init__(self, num_input_features, growth_rate, bottleneck_width, drop_rate):
@@ -26,26 +32,106 @@ class _DenseLayer(nn.Module):
         self.branch2b = BasicConv2d(inter_channel, growth_rate, kernel_size=3, padding=1)
         self.branch2c = BasicConv2d(growth_rate, growth_rate, kernel_size=3, padding=1)
         
+        self.growth_rate = growth_rate
+        self.inter_channel = inter_channel
+        self.branch_a = None
+        self.memory_efficient = False
         self.f_cat = torch.nn.quantized.FloatFunctional()
 
     def forward(self, x):
-        branch1 = self.branch1a(x)
+        branch1, branch2 = self.branches(x)
+
+        return _cat(self.f_cat, [x, branch1, branch2], 1)
+
+    def bottleneck(self, *features):
+        x = features[0] if len(features) == 1 else torch.cat(features, 1)
+        if self.branch_a is not None:
+            return tuple(self.branch_a(x).split(self.inter_channel, 1))
+
+        return self.branch1a(x), self.branch2a(x)
+
+    def branches(self, *features):
+        if self.memory_efficient and any(f.requires_grad for f in features):
+            # the concatenated input and the conv/BN intermediates of the 1x1
+            # bottleneck convs are dropped after forward and recomputed in backward.
+            # The bottleneck outputs are not: branch1b and branch2b save them as
+            # their inputs. The BatchNorm running stats see the recomputation as a
+            # second update, as in torchvision's DenseNet
+            branch1, branch2 = cp.checkpoint(self.bottleneck, *features, use_reentrant=False)
+        else:
+            branch1, branch2 = self.bottleneck(*features)
+
         branch1 = self.branch1b(branch1)
 
-        branch2 = self.branch2a(x)
         branch2 = self.branch2b(branch2)
         branch2 = self.branch2c(branch2)
 
-        return self.f_cat.cat([x, branch1, branch2], 1)
+        return branch1, branch2
+
+    def merge_branches(self):
+        # branch1a and branch2a both read x: run them as one conv with
+        # 2 * inter_channel outputs and split the result.
+        if self.branch_a is None:
+            self.branch_a = _merge_convs([self.branch1a, self.branch2a])
+            del self.branch1a
+            del self.branch2a
 
 
 class _DenseBlock(nn.Sequential):
-    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate):
+    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate, shared_buffer=False,
+                 memory_efficient=False):
         super(_DenseBlock, self).__init__()
         for i in range(num_layers):
             layer = _DenseLayer(num_input_features + i * growth_rate, growth_rate, bn_size, drop_rate)
+            layer.memory_efficient = memory_efficient
             self.add_module('denselayer%d' % (i + 1), layer)
 
+        self.num_input_features = num_input_features
+        self.num_output_features = num_input_features + sum(2 * m.growth_rate for m in self.children())
+        self.shared_buffer = shared_buffer
+        self.memory_efficient = memory_efficient
+
+    def forward(self, x):
+        # a model prepared for quantization observes every cat, keep the plain path
+        if getattr(self, 'qconfig', None) is None and not x.is_quantized:
+            if self.shared_buffer and not torch.is_grad_enabled():
+                return self._forward_shared(x)
+            if self.memory_efficient and torch.is_grad_enabled():
+                return self._forward_checkpointed(x)
+
+        return super(_DenseBlock, self).forward(x)
+
+    def _forward_checkpointed(self, x):
+        # Layers get the list of earlier outputs and concatenate it inside their
+        # checkpointed bottleneck, so only one concatenation per block is kept.
+        features = [x]
+        for layer in self.children():
+            features.extend(layer.branches(*features))
+
+        return torch.cat(features, 1)
+
+    def _forward_shared(self, x):
+        # One buffer at the final width: each layer reads a view of the channels
+        # written so far and copies in only its own growth channels, instead of
+        # re-concatenating the whole feature map at every layer.
+        n, c, h, w = x.size()
+        if x.is_contiguous():
+            memory_format = torch.contiguous_format
+        else:
+            memory_format = torch.channels_last
+        out = torch.empty((n, self.num_output_features, h, w), dtype=x.dtype, device=x.device,
+                          memory_format=memory_format)
+        out[:, :c].copy_(x)
+
+        for layer in self.children():
+            branch1, branch2 = layer.branches(out[:, :c])
+            out[:, c:c + branch1.size(1)].copy_(branch1)
+            c += branch1.size(1)
+            out[:, c:c + branch2.size(1)].copy_(branch2)
+            c += branch2.size(1)
+
+        return out
+
 
 
 class _StemBlock(nn.Module):
@@ -69,7 +155,7 @@ class _StemBlock(nn.Module):
         branch2 = self.stem2b(branch2)
         branch1 = self.pool(out)
 
-        out = self.f_cat.cat([branch1, branch2], 1)
+        out = _cat(self.f_cat, [branch1, branch2], 1)
         out = self.stem3(out)
 
         return out
@@ -82,16 +168,149 @@ class BasicConv2d(nn.Module):
         super(BasicConv2d, self).__init__()
         self.conv = nn.Conv2d(in_channels, out_channels, bias=False, **kwargs)
         self.norm = nn.BatchNorm2d(out_channels) 
+        self.relu = nn.ReLU(inplace=True)
         self.activation = activation
 
     def forward(self, x):
-        x = self.conv(x)
+        if _is_channel_slice(x) and _is_pointwise(self.conv):
+            x = _pointwise_conv(self.conv, x)
+        else:
+            x = self.conv(x)
         x = self.norm(x)
         if self.activation:
-            return F.relu(x, inplace=True)
+            return self.relu(x)
         else:
             return x
 
+    def fuse(self, qat=False):
+        # qat keeps BatchNorm as a module of the fused conv, to be trained with fake quantization
+        if type(self.norm) != nn.BatchNorm2d:
+            return
+        fuse_modules = torch.quantization.fuse_modules
+        if qat:
+            fuse_modules = getattr(torch.quantization, 'fuse_modules_qat', fuse_modules)
+        if self.activation:
+            fuse_modules(self, ['conv', 'norm', 'relu'], inplace=True)
+        else:
+            fuse_modules(self, ['conv', 'norm'], inplace=True)
+
+
+class _GlobalPoolLinear(nn.Module):
+    """Global average pooling and the classifier folded into one addmm over the spatial mean"""
+    def __init__(self, linear):
+        super(_GlobalPoolLinear, self).__init__()
+        self.weight = linear.weight
+        self.bias = linear.bias
+
+    def forward(self, x):
+        return torch.addmm(self.bias, x.mean((2, 3)), self.weight.t())
+
+class _PixelInput(nn.Module):
+    """Turns a uint8 batch into the float input of a stem conv with the normalization folded in.
+
+    The border is filled with the mean pixel rather than zero, which is what zero
+    padding of the normalized image amounts to, so the conv runs unpadded.
+    """
+    def __init__(self, mean, padding, channels_last=False):
+        super(_PixelInput, self).__init__()
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1) * 255, persistent=False)
+        self.padding = padding
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.permute(0, 3, 1, 2)
+        n, c, h, w = x.size()
+        p = self.padding
+        if x.is_contiguous() or not x.is_contiguous(memory_format=torch.channels_last):
+            memory_format = torch.contiguous_format
+        else:
+            memory_format = torch.channels_last
+        out = torch.empty((n, c, h + 2 * p, w + 2 * p), dtype=self.mean.dtype, device=x.device,
+                          memory_format=memory_format)
+        if p > 0:
+            mean = self.mean.expand(n, c, p, w + 2 * p)
+            out[:, :, :p].copy_(mean)
+            out[:, :, -p:].copy_(mean)
+            mean = self.mean.expand(n, c, h, p)
+            out[:, :, p:-p, :p].copy_(mean)
+            out[:, :, p:-p, -p:].copy_(mean)
+        out[:, :, p:p + h, p:p + w].copy_(x)
+
+        return out
+
+
+def _merge_convs(convs):
+    """Stacks BasicConv2d layers that share an input into one, output channels in order"""
+    first = convs[0].conv
+    merged = BasicConv2d(first.in_channels, sum(m.conv.out_channels for m in convs),
+                         activation=convs[0].activation, kernel_size=first.kernel_size,
+                         stride=first.stride, padding=first.padding)
+    for m in convs:
+        assert type(m.conv) == nn.Conv2d and type(m.norm) == nn.BatchNorm2d, 'merge before fusing'
+        assert m.conv.in_channels == first.in_channels and m.conv.kernel_size == first.kernel_size and \
+            m.conv.stride == first.stride and m.conv.padding == first.padding and \
+            m.activation == convs[0].activation, 'only identical convs can be merged'
+
+    with torch.no_grad():
+        merged.conv.weight.copy_(torch.cat([m.conv.weight for m in convs], 0))
+        for name in ['weight', 'bias', 'running_mean', 'running_var']:
+            getattr(merged.norm, name).copy_(torch.cat([getattr(m.norm, name) for m in convs], 0))
+        merged.norm.num_batches_tracked.copy_(convs[0].norm.num_batches_tracked)
+    merged.norm.eps = convs[0].norm.eps
+    merged.norm.momentum = convs[0].norm.momentum
+    merged.train(convs[0].training)
+
+    return merged
+
+
+def _cat(f_cat, tensors, dim):
+    """f_cat.cat, or a plain byte concatenation of int8 inputs that already have the output's scale.
+
+    quantized::cat dequantizes and requantizes every element even then; with
+    quantization.share_concat_observers the whole concat group shares one scale.
+    """
+    if type(f_cat) == nnq.QFunctional and tensors[0].is_quantized and \
+            all(t.q_scale() == f_cat.scale and t.q_zero_point() == f_cat.zero_point for t in tensors):
+        return torch._make_per_tensor_quantized_tensor(
+            torch.cat([t.int_repr() for t in tensors], dim), f_cat.scale, f_cat.zero_point)
+    return f_cat.cat(tensors, dim)
+
+
+def _is_channel_slice(x):
+    return not x.is_quantized and x.dim() == 4 and \
+        not x.is_contiguous() and not x.is_contiguous(memory_format=torch.channels_last)
+
+
+def _is_pointwise(conv):
+    if getattr(conv, 'qconfig', None) is not None:
+        # observers hang off the module's own forward
+        return False
+    if type(conv) == nni.ConvReLU2d:
+        conv = conv[0]
+    return type(conv) == nn.Conv2d and conv.kernel_size == (1, 1) and conv.stride == (1, 1) and \
+        conv.padding == (0, 0) and conv.dilation == (1, 1) and conv.groups == 1
+
+
+def _pointwise_conv(conv, x):
+    # A channel slice of a dense block buffer is not dense, so nn.Conv2d would copy it
+    # first. Every pixel row is still contiguous in the channel dim (NHWC) or every
+    # sample plane is (NCHW), which is all a GEMM needs, so run the 1x1 conv as one.
+    if type(conv) == nni.ConvReLU2d:
+        return conv[1](_pointwise_conv(conv[0], x))
+
+    n, c, h, w = x.size()
+    weight = conv.weight.view(conv.out_channels, c)
+    if x.stride(1) == 1:
+        out = torch.mm(x.permute(0, 2, 3, 1).flatten(0, 2), weight.t())
+        out = out.view(n, h, w, conv.out_channels).permute(0, 3, 1, 2)
+    else:
+        out = torch.bmm(weight.expand(n, -1, -1), x.flatten(2)).view(n, conv.out_channels, h, w)
+    if conv.bias is not None:
+        out += conv.bias.view(1, -1, 1, 1)
+    return out
+
+
 class PeleeNet(nn.Module):
     r"""PeleeNet model class, based on
     `"Densely Connected Convolutional Networks" <https://arxiv.org/pdf/1608.06993.pdf> and
@@ -104,12 +323,21 @@ class PeleeNet(nn.Module):
           (i.e. bn_size * k features in the bottleneck layer)
         drop_rate (float) - dropout rate after each dense layer
         num_classes (int) - number of classification classes
+        shared_buffer (bool) - in inference, let each dense block write into one preallocated
+          buffer instead of concatenating at every layer
+        checkpoint_blocks (list of ints) - dense blocks (1-based) that recompute their concatenations
+          and bottleneck convs in backward instead of storing them
     """
     def __init__(self, growth_rate=32, block_config=[3, 4, 8, 6],
-                 num_init_features=32, bottleneck_width=[1, 2, 4, 4], drop_rate=0.05, num_classes=1000):
+                 num_init_features=32, bottleneck_width=[1, 2, 4, 4], drop_rate=0.05, num_classes=1000,
+                 shared_buffer=False, checkpoint_blocks=()):
 
         super(PeleeNet, self).__init__()
 
+        self.config = dict(growth_rate=growth_rate, block_config=block_config,
+                           num_init_features=num_init_features, bottleneck_width=bottleneck_width,
+                           drop_rate=drop_rate, num_classes=num_classes, shared_buffer=shared_buffer,
+                           checkpoint_blocks=list(checkpoint_blocks))
 
         self.features = nn.Sequential(OrderedDict([
             ('stemblock', _StemBlock(3, num_init_features)), 
@@ -132,7 +360,8 @@ class PeleeNet(nn.Module):
         num_features = num_init_features
         for i, num_layers in enumerate(block_config):
             block = _DenseBlock(num_layers=num_layers, num_input_features=num_features,
-                                bn_size=bottleneck_widths[i], growth_rate=growth_rates[i], drop_rate=drop_rate)
+                                bn_size=bottleneck_widths[i], growth_rate=growth_rates[i], drop_rate=drop_rate,
+                                shared_buffer=shared_buffer, memory_efficient=(i + 1) in checkpoint_blocks)
             self.features.add_module('denseblock%d' % (i + 1), block)
             num_features = num_features + num_layers * growth_rates[i]
 
@@ -155,20 +384,104 @@ class PeleeNet(nn.Module):
         self.quant = QuantStub()
         self.dequant = DeQuantStub()
 
+        self.input_norm = None
+        self.features_dtype = None
+
     def forward(self, x):
+        if self.input_norm is not None:
+            x = self.input_norm(x)
         x = self.quant(x)
+        if self.features_dtype is not None:
+            x = x.to(self.features_dtype)
         features = self.features(x)
+        if self.features_dtype is not None:
+            features = features.float()
+        if isinstance(self.classifier, _GlobalPoolLinear):
+            return self.dequant(self._classify(features))
+
         out = F.avg_pool2d(features, kernel_size=(features.size(2), features.size(3))).view(features.size(0), -1)
         if self.drop_rate > 0:
             out = F.dropout(out, p=self.drop_rate, training=self.training)
-        out = self.classifier(out)
+        out = self._classify(out)
         out = self.dequant(out)
         return out
 
-    def fuse(self):
+    def _classify(self, x):
+        if torch.is_autocast_cpu_enabled():
+            # keep the logits, and the loss computed from them, in FP32
+            with torch.autocast('cpu', enabled=False):
+                return self.classifier(x.float())
+        return self.classifier(x)
+
+    def optimize_for_inference(self, fold_head=True):
+        """Rewrites the model in place for inference.
+
+        The 1x1 convs that read the same input are merged, BatchNorm and ReLU are
+        folded into the convs and, with fold_head, the global pooling and the
+        classifier become a single op (FP32 only, keep it off for quantization).
+        """
+        self.eval()
+        layers = [m for m in self.modules() if isinstance(m, _DenseLayer)]
+        for layer in layers:
+            layer.merge_branches()
+
+        self.fuse()
+
+        if fold_head and not isinstance(self.classifier, _GlobalPoolLinear):
+            self.classifier = _GlobalPoolLinear(self.classifier)
+        self.config['fold_head'] = fold_head
+
+        return self
+
+    def fold_normalization(self, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], channels_last=False):
+        """Makes the model take uint8 pixels, NCHW or with channels_last NHWC.
+
+        The ToTensor/Normalize scaling and shift go into the weights and bias of
+        the first conv, so preprocessing is only resize and crop. Call it after
+        loading the weights; with int8, the QuantStub then sees plain byte values.
+        """
+        assert self.input_norm is None, 'normalization is already folded'
+        stem1 = self.features.stemblock.stem1
+        conv = stem1.conv[0] if type(stem1.conv) == nni.ConvReLU2d else stem1.conv
+        assert type(conv) == nn.Conv2d, 'fold the normalization before quantizing'
+
+        scale = 1.0 / (255 * torch.tensor(std, dtype=conv.weight.dtype))
+        shift = -torch.tensor(mean, dtype=conv.weight.dtype) / torch.tensor(std, dtype=conv.weight.dtype)
+        with torch.no_grad():
+            bias = (conv.weight * shift.view(1, -1, 1, 1)).sum((1, 2, 3))
+            conv.weight.mul_(scale.view(1, -1, 1, 1))
+            if type(stem1.norm) == nn.BatchNorm2d:
+                # BN(y + b) == BN(y) with its running mean moved by -b
+                stem1.norm.running_mean.sub_(bias)
+            elif conv.bias is not None:
+                conv.bias.add_(bias)
+            else:
+                conv.bias = nn.Parameter(bias)
+
+        self.input_norm = _PixelInput(mean, conv.padding[0], channels_last=channels_last)
+        conv.padding = (0, 0)
+        self.config['input_norm'] = dict(mean=list(mean), std=list(std), channels_last=channels_last)
+
+        return self
+
+    def to_bfloat16(self):
+        """Stores the feature weights in BF16 for inference, the classifier stays FP32.
+
+        BatchNorm is folded into the convs before the cast, so no BF16 BatchNorm
+        runs; its statistics end up in the BF16 conv weights and biases.
+        """
+        self.eval()
+        self.fuse()
+        self.features.to(torch.bfloat16)
+        self.features_dtype = torch.bfloat16
+        self.config['bfloat16'] = True
+
+        return self
+
+    def fuse(self, qat=False):
         for m in self.modules():
             if type(m) == BasicConv2d:
-                torch.quantization.fuse_modules(m, ['conv', 'norm'], inplace=True)
+                m.fuse(qat=qat)
 
 
     def _initialize_weights(self):
@@ -187,6 +500,73 @@ class PeleeNet(nn.Module):
                 m.bias.data.zero_()
 
 
+def save_inference_model(model, filename, source=None):
+    """Saves a model rewritten for inference (optimize_for_inference, fold_normalization,
+    to_bfloat16 or int8 conversion) together with what rebuilds it, and source, the
+    digest of the checkpoint it was made from"""
+    config = dict(model.config)
+    fold_head = config.pop('fold_head', None)
+    input_norm = config.pop('input_norm', None)
+    bfloat16 = config.pop('bfloat16', False)
+    qbackend = config.pop('qbackend', None)
+    torch.save({
+        'arch': 'peleenet',
+        'config': config,
+        'fold_head': fold_head,
+        'input_norm': input_norm,
+        'bfloat16': bfloat16,
+        'qbackend': qbackend,
+        'checkpoint': source,
+        'state_dict': model.state_dict(),
+    }, filename)
+
+
+def load_inference_model(filename):
+    return _inference_model(torch.load(filename, map_location=torch.device('cpu')))
+
+
+def inference_model_source(filename):
+    """Digest of the checkpoint a save_inference_model artifact was made from, None if not recorded"""
+    return torch.load(filename, map_location=torch.device('cpu')).get('checkpoint')
+
+
+def _inference_model(checkpoint):
+    model = PeleeNet(**checkpoint['config'])
+    model.eval()
+    if checkpoint['fold_head'] is not None:
+        model.optimize_for_inference(fold_head=checkpoint['fold_head'])
+    if checkpoint.get('input_norm'):
+        model.fold_normalization(**checkpoint['input_norm'])
+    if checkpoint.get('bfloat16'):
+        model.to_bfloat16()
+    if checkpoint.get('qbackend'):
+        import quantization
+        quantization.quantized_structure(model, checkpoint['qbackend'])
+    model.load_state_dict(checkpoint['state_dict'])
+
+    return model
+
+
+def load_model(filename, **kwargs):
+    """Builds PeleeNet from a main.py checkpoint or a save_inference_model artifact.
+
+    kwargs go to the PeleeNet constructor for training checkpoints, which do not
+    record their configuration.
+    """
+    checkpoint = torch.load(filename, map_location=torch.device('cpu'))
+    if 'config' in checkpoint:
+        return _inference_model(checkpoint)
+
+    # checkpoints written by a (Distributed)DataParallel model carry a prefix
+    state_dict = OrderedDict((k[len('module.'):] if k.startswith('module.') else k, v)
+                             for k, v in checkpoint['state_dict'].items())
+    kwargs.setdefault('num_classes', state_dict['classifier.weight'].size(0))
+    model = PeleeNet(**kwargs)
+    model.load_state_dict(state_dict)
+
+    return model
+
+
 if __name__ == '__main__':
     model = PeleeNet()
     print(model)
@@ -0,0 +1,84 @@
+"""Background batch preparation for the train and validation loops."""
+import queue
+import threading
+import time
+
+import torch
+
+
+class Prefetcher(object):
+    """Prepares batch N+1 on a background thread while batch N runs.
+
+    Each input is converted to the requested memory format (and floating point
+    inputs to dtype) while it is copied into a ring of depth + 1 reused
+    buffers, optionally pinned. wait_time is how long the consumer last blocked
+    waiting for a batch, total_wait the sum over the current pass.
+
+    A yielded input is only valid until the next batch is requested.
+    """
+    def __init__(self, loader, memory_format=torch.contiguous_format, dtype=None, depth=2, pin_memory=False):
+        self.loader = loader
+        self.memory_format = memory_format
+        self.dtype = dtype
+        self.depth = depth
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.buffers = [None] * (depth + 1)
+        self.wait_time = 0.0
+        self.total_wait = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _fill(self, slot, input):
+        dtype = self.dtype if self.dtype is not None and input.is_floating_point() else input.dtype
+        buf = self.buffers[slot]
+        if buf is None or buf.dtype != dtype or buf.shape[1:] != input.shape[1:] or buf.size(0) < input.size(0):
+            buf = torch.empty(input.shape, dtype=dtype, memory_format=self.memory_format,
+                              pin_memory=self.pin_memory)
+            self.buffers[slot] = buf
+        # the leading rows of an NCHW or NHWC buffer are still dense
+        out = buf[:input.size(0)]
+        out.copy_(input)
+        return out
+
+    def _produce(self, free, ready, stop):
+        try:
+            for input, target in self.loader:
+                slot = free.get()
+                if slot is None or stop.is_set():
+                    return
+                ready.put((slot, self._fill(slot, input), target))
+            ready.put(None)
+        except Exception as e:
+            ready.put(e)
+
+    def __iter__(self):
+        free = queue.Queue()
+        ready = queue.Queue()
+        for slot in range(self.depth + 1):
+            free.put(slot)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(free, ready, stop), daemon=True)
+        thread.start()
+
+        self.total_wait = 0.0
+        slot = None
+        try:
+            while True:
+                # the previous batch is done with once the next one is asked for
+                if slot is not None:
+                    free.put(slot)
+                t0 = time.perf_counter()
+                item = ready.get()
+                self.wait_time = time.perf_counter() - t0
+                self.total_wait += self.wait_time
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                slot, input, target = item
+                yield input, target
+        finally:
+            stop.set()
+            free.put(None)
+            thread.join()
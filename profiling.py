@@ -1,135 +1,219 @@
+import csv
+import json
+import math
+import os
+import numpy as np
 import torch
-from torch.autograd import Variable
-from torch.autograd import Function
 import time
 
-from peleenet import _DenseLayer, _DenseBlock, _StemBlock, BasicConv2d, PeleeNet
-
-class Profiling(object):
-    def __init__(self, model, pid, enabled=True):
-        if isinstance(model, torch.nn.Module) is False:
-            print("Not a valid model, please provide a 'nn.Module' instance.")
-
-        self.model = model
-        self.pid = pid
-        self.enabled = enabled
-        self.record = {'forward':[], 'backward': []}
-        self.profiling_on = True
-        self.origin_call = {}
-        self.hook_done = False
-        self.layer_num = 0
-
-    def __enter__(self):
-        if self.enabled:
-            self.start()
-
-        return self
-
-    def __exit__(self, *args):
-        if self.enabled:
-            self.stop()
-
-    def __str__(self):
-        ret = ""
-
-        iter = len(self.record['forward']) / self.layer_num
-
-        for i in range(iter):
-            ret += "\n================================= Iteration {} =================================\n".format(i + 1)
-
-            ret += "\nFORWARD TIME:\n\n"
-            for j in xrange(self.layer_num):
-                record_item = self.record['forward'][i * self.layer_num + j]
-                ret += "layer{:3d}:          {:.6f} ms          ({})\n".format(j + 1, record_item[2] - record_item[1], record_item[0])
-
-            ret += "\nBACKWARD TIME:\n\n"
-            for j in (xrange(self.layer_num)):
-                record_item = self.record['backward'][i * self.layer_num + self.layer_num - j - 1]
-                try:
-                    ret += "layer{:3d}:          {:.6f} ms          ({})\n".format(j + 1, record_item[2] - record_item[1], record_item[0])
-                except:
-                    # Oops, this layer doesn't execute backward post-hooks
-                    pass
-
+from peleenet import BasicConv2d
+
+
+def percentile(values, p):
+    """Nearest-rank p-th percentile of values, nan when there are none.
+
+    The one definition behind the p50/p90/p99 of every tool, so that their
+    numbers compare.
+    """
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def layers(module, prefix=''):
+    """[(name, module)] of the BasicConv2d units and of the leaf modules outside of them"""
+    if isinstance(module, torch.nn.parallel.DistributedDataParallel):
+        module = module.module
+    found = []
+    for name, m in module.named_children():
+        name = prefix + name
+        if isinstance(m, (torch.nn.quantized.FloatFunctional, torch.nn.quantized.QFunctional)):
+            # called through .cat, never through forward
+            continue
+        if isinstance(m, BasicConv2d) or not list(m.children()):
+            found.append((name, m))
+        else:
+            found.extend(layers(m, name + '.'))
+    return found
+
+
+class LayerProfiler(object):
+    """Per-layer forward and backward wall time, cheap enough to leave on.
+
+    Layers are the BasicConv2d units and the modules outside of them (pools,
+    classifier, input conversion). Every sampled iteration writes one
+    perf_counter_ns duration per layer into preallocated arrays, a ring of
+    `capacity` iterations; the other iterations cost one attribute check per
+    hook. Call step() at the end of every iteration, after backward when
+    training: it closes the last backward interval and picks the next sample.
+
+    Backward time is the interval from a layer's output gradient being ready to
+    the next such event, i.e. the time autograd spends between the layers.
+    Forward calls made during backward, the recomputation of checkpointed
+    layers (--checkpoint-segments), are not timed as forward: their time stays
+    in the backward interval they happen in. Not thread-safe: one profiler per
+    model instance.
+
+    Args:
+        every (int) - sample one iteration out of every (1: all of them)
+        capacity (int) - sampled iterations kept for the statistics and the trace
+    """
+    def __init__(self, model, every=1, capacity=1000):
+        found = layers(model)
+        self.names = [name for name, _ in found]
+        modules = [m for _, m in found]
+        self.every = every
+        self.capacity = capacity
+
+        shape = (len(modules), capacity)
+        self.forward = np.zeros(shape, dtype=np.int64)
+        self.forward_start = np.zeros(shape, dtype=np.int64)
+        self.backward = np.zeros(shape, dtype=np.int64)
+        self.backward_start = np.zeros(shape, dtype=np.int64)
+        self.calls = np.zeros(shape, dtype=np.int32)
+        self._t0 = np.zeros(len(modules), dtype=np.int64)
+
+        self.iteration = 0
+        self.samples = 0
+        self.slot = 0
+        self.active = False
+        self.paused = False
+        # set by the first gradient of an iteration, cleared by step()
+        self.in_backward = False
+        self._open = None
+        self._begin()
+
+        self._handles = []
+        for idx, m in enumerate(modules):
+            self._handles.append(m.register_forward_pre_hook(self._pre_hook(idx)))
+            self._handles.append(m.register_forward_hook(self._post_hook(idx)))
+
+    def _pre_hook(self, idx):
+        def hook(module, input):
+            if self.active and not self.in_backward:
+                self._t0[idx] = time.perf_counter_ns()
+        return hook
+
+    def _post_hook(self, idx):
+        def hook(module, input, output):
+            if not self.active or self.in_backward:
+                return
+            now = time.perf_counter_ns()
+            if self.calls[idx, self.slot] == 0:
+                self.forward_start[idx, self.slot] = self._t0[idx]
+            self.forward[idx, self.slot] += now - self._t0[idx]
+            self.calls[idx, self.slot] += 1
+            if isinstance(output, torch.Tensor) and output.requires_grad:
+                output.register_hook(self._grad_hook(idx))
+        return hook
+
+    def _grad_hook(self, idx):
+        def hook(grad):
+            now = time.perf_counter_ns()
+            self.in_backward = True
+            self._close(now)
+            self._open = (idx, now)
+        return hook
+
+    def _close(self, now):
+        if self._open is not None:
+            idx, t0 = self._open
+            if self.backward[idx, self.slot] == 0:
+                self.backward_start[idx, self.slot] = t0
+            self.backward[idx, self.slot] += now - t0
+            self._open = None
+
+    def _begin(self):
+        self.in_backward = False
+        self.active = self.iteration % self.every == 0
+        if self.active:
+            self.slot = self.samples % self.capacity
+            for a in (self.forward, self.backward, self.calls):
+                a[:, self.slot] = 0
+
+    def step(self):
+        """Ends the iteration"""
+        if self.paused:
+            return
+        self._close(time.perf_counter_ns())
+        if self.active:
+            self.samples += 1
+        self.iteration += 1
+        self._begin()
+
+    def pause(self):
+        """Stops recording, e.g. for the validation passes of a training run"""
+        self.paused = True
+        self.active = False
+        self._open = None
+
+    def resume(self):
+        self.paused = False
+        self._begin()
+
+    def remove(self):
+        for h in self._handles:
+            h.remove()
+        self._handles = []
+
+    def _valid(self):
+        # the slots of completed samples, oldest first
+        n = min(self.samples, self.capacity)
+        first = self.samples % self.capacity if self.samples > self.capacity else 0
+        return [(first + i) % self.capacity for i in range(n)]
+
+    def summary(self):
+        """One dict per layer with the mean and percentiles in ms over the sampled iterations"""
+        slots = self._valid()
+        rows = []
+        for idx, name in enumerate(self.names):
+            ran = [s for s in slots if self.calls[idx, s] > 0]
+            row = {'layer': name, 'samples': len(ran)}
+            for kind, values in (('forward', self.forward), ('backward', self.backward)):
+                ms = values[idx, ran] / 1e6
+                for stat, value in (('mean', ms.mean() if len(ms) else 0.0),
+                                    ('p50', percentile(ms, 50) if len(ms) else 0.0),
+                                    ('p90', percentile(ms, 90) if len(ms) else 0.0),
+                                    ('p99', percentile(ms, 99) if len(ms) else 0.0)):
+                    row['{}_{}_ms'.format(kind, stat)] = float(value)
+            rows.append(row)
+        return rows
+
+    def table(self, sort_by='forward_mean_ms', limit=None):
+        rows = sorted([r for r in self.summary() if r['samples']], key=lambda r: -r[sort_by])[:limit]
+        total = sum(r['forward_mean_ms'] + r['backward_mean_ms'] for r in rows) or 1.0
+        ret = '{:48s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s} {:>6s}\n'.format(
+            'layer', 'samples', 'fw mean', 'fw p50', 'fw p99', 'bw mean', 'bw p99', 'share')
+        for r in rows:
+            ret += '{:48s} {:7d} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:6.1%}\n'.format(
+                r['layer'], r['samples'], r['forward_mean_ms'], r['forward_p50_ms'], r['forward_p99_ms'],
+                r['backward_mean_ms'], r['backward_p99_ms'],
+                (r['forward_mean_ms'] + r['backward_mean_ms']) / total)
         return ret
 
-    def start(self):
-        if self.hook_done is False:
-            self.hook_done = True
-            self.hook_modules(self.model)
-
-        self.profiling_on = True
-
-        return self
-
-    def stop(self):
-        self.profiling_on = False
-
-        return self
-
-    def hook_modules(self, module, u_t_name=''):
-
-        this_profiler = self
-
-        sub_modules = module.__dict__['_modules']
-        class_modules = [torch.nn.parallel.distributed.DistributedDataParallel, torch.nn.Sequential, _DenseLayer, _DenseBlock, _StemBlock, BasicConv2d, PeleeNet]
-        class_containers = [torch.nn.modules.container.ModuleList]
-
-        m_name = module._get_name()
-        if u_t_name != '':
-            m_name = u_t_name + '/' + m_name
-        else:
-            m_name = '[{}] {}'.format(self.pid, m_name)
-        for name, sub_module in sub_modules.items():
-            if any(isinstance(sub_module, c) for c in class_modules):
-                self.hook_modules(sub_module, m_name)
-            elif any(isinstance(sub_module, c) for c in class_containers):
-                m_name = m_name + '/' + sub_module._get_name()
-                for sub_sub_module in sub_module:
-                    self.hook_modules(sub_sub_module, m_name)
-            else:
-                def forward_post_hook(module, input, output):
-                    if (this_profiler.profiling_on):
-                        msg = 'forward: {}/{}'.format(m_name, module._get_name())
-                        print(msg)
-                        _para = module.__dict__['_parameters']
-                        for t in _para:
-                            print('  [{}] {}: {} {} {}'.format(self.pid, t, _para[t].dtype, _para[t].shape, _para[t].requires_grad))
-                        print('  [{}] input:'.format(self.pid))
-                        id_t = 0
-                        for t in input:
-                            print('    [{}] {} {} {}'.format(self.pid, id_t, t.dtype, t.shape))
-                            print('    [{}] {} {}'.format(self.pid, id_t, t))
-                            id_t = id_t + 1
-                        print('  [{}] output:'.format(self.pid))
-                        id_t = 0
-                        for t in input:
-                            print('    [{}] {} {} {}'.format(self.pid, id_t, t.dtype, t.shape))
-                            print('    [{}] {} {}'.format(self.pid, id_t, t))
-                            id_t = id_t + 1
-
-                def backward_post_hook(module, input, output):
-                    if (this_profiler.profiling_on):
-                        msg = 'backward: {}/{}'.format(m_name, module._get_name())
-                        if hasattr(module, 'weight'):
-                            msg = '{} {} {}'.format(msg, module.weight.dtype, module.weight.shape)
-                        else:
-                            msg = '{} {} {}'.format(msg, 'torch.None', 'torch.Size([])')
-                        if hasattr(module, 'bias'):
-                            msg = '{} {} {}'.format(msg, module.bias.dtype, module.bias.shape)
-                        else:
-                            msg = '{} {} {}'.format(msg, 'torch.None', 'torch.Size([])')
-                        print(msg)
-                        print('  [{}] input:'.format(self.pid))
-                        id_t = 0
-                        for t in input:
-                            print('    [{}] {} {} {}'.format(self.pid, id_t, t.dtype, t.shape))
-                            id_t = id_t + 1
-                        print('  [{}] output:'.format(self.pid))
-                        id_t = 0
-                        for t in input:
-                            print('    [{}] {} {} {}'.format(self.pid, id_t, t.dtype, t.shape))
-                            id_t = id_t + 1
-
-                sub_module.register_forward_hook(forward_post_hook)
-                sub_module.register_backward_hook(backward_post_hook)
+    def __str__(self):
+        return self.table()
+
+    def export_csv(self, path):
+        rows = self.summary()
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def export_chrome_trace(self, path):
+        """Every sampled iteration as complete events, forward and backward on separate rows"""
+        events = []
+        pid = os.getpid()
+        for s in self._valid():
+            for idx, name in enumerate(self.names):
+                if self.calls[idx, s] == 0:
+                    continue
+                events.append({'name': name, 'cat': 'forward', 'ph': 'X', 'pid': pid, 'tid': 0,
+                               'ts': self.forward_start[idx, s] / 1e3, 'dur': self.forward[idx, s] / 1e3})
+                if self.backward[idx, s] > 0:
+                    events.append({'name': name, 'cat': 'backward', 'ph': 'X', 'pid': pid, 'tid': 1,
+                                   'ts': self.backward_start[idx, s] / 1e3, 'dur': self.backward[idx, s] / 1e3})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,225 @@
+"""Int8 quantization of PeleeNet with torch.quantization.
+
+fuse() folds BatchNorm and ReLU into the convs, then the model gets a
+per-channel qconfig for the fbgemm (x86) or qnnpack (ARM) backend, is prepared,
+sees a few calibration batches and is converted. prepare_qat is the
+quantization-aware training counterpart, converted the same way after
+fine-tuning.
+
+The activation observer statistics can be kept in a calibration cache, keyed by
+module name and tied to the digest of the checkpoint they were measured on.
+They do not depend on the backend or the weight observers, so re-quantizing the
+same checkpoint with another qconfig, or after a change that keeps the module
+names, skips calibration. The converted model is saved and loaded with
+peleenet.save_inference_model/load_model.
+"""
+import contextlib
+import itertools
+import os
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+import torch.nn.intrinsic.qat as nniqat
+import torch.quantization as tq
+
+from peleenet import BasicConv2d, _DenseBlock
+
+
+def qconfig(backend='fbgemm'):
+    """Histogram activation observers and per-channel symmetric weights.
+
+    fbgemm activations use 7 bits to stay clear of the overflow of its
+    16-bit accumulation on CPUs without VNNI.
+    """
+    return tq.QConfig(activation=tq.HistogramObserver.with_args(reduce_range=backend == 'fbgemm'),
+                      weight=tq.default_per_channel_weight_observer)
+
+
+def activation_observers(model):
+    """{name: observer} of a prepared model, weight observers only exist during convert.
+
+    An observer shared by several modules is named after all of them, joined
+    by '+', so a cache written with other sharing does not match.
+    """
+    observers = OrderedDict()
+    for name, m in model.named_modules():
+        observer = getattr(m, 'activation_post_process', None)
+        if not isinstance(observer, nn.Module) or name.endswith('activation_post_process'):
+            continue
+        prefix = name + '.' if name else ''
+        observers.setdefault(id(observer), (observer, []))[1].append(prefix + 'activation_post_process')
+    return OrderedDict(('+'.join(names), observer) for observer, names in observers.values())
+
+
+def concat_groups(model):
+    """Modules whose outputs meet in the same concatenation, with the cat itself.
+
+    A dense block concatenates its input, the branch1b and branch2c outputs of
+    every layer and the output of every earlier cat, so all of them are one
+    group with the module that produced the block input (the stem's last conv,
+    or the previous transition conv, average pooling keeps its scale). The
+    stem concatenates the max-pooled stem1 output with stem2b.
+    """
+    features = model.features
+    stem = features.stemblock
+    groups = [[stem.stem1.conv, stem.stem2b.conv, stem.f_cat]]
+    producer = stem.stem3.conv
+    for name, m in features.named_children():
+        if isinstance(m, _DenseBlock):
+            group = [producer]
+            for layer in m.children():
+                group.extend([layer.branch1b.conv, layer.branch2c.conv, layer.f_cat])
+            groups.append(group)
+        elif isinstance(m, BasicConv2d):
+            producer = m.conv
+    return groups
+
+
+def share_concat_observers(model, backend='fbgemm'):
+    """Gives every concat group of a prepared model a single activation observer.
+
+    After convert all members of a group share one scale and zero point and
+    peleenet._cat turns the concatenations into byte copies, so the observer
+    has to see the union of the group's ranges. The calibration observers
+    accumulate; the moving-average fake quantization of QAT would average the
+    members' ranges and clip, so prepare_qat models share a MinMax one instead.
+    Call it before calibration or fine-tuning.
+    """
+    for group in concat_groups(model):
+        assert all(hasattr(m, 'activation_post_process') for m in group), 'prepare the model first'
+        if isinstance(group[0].activation_post_process, tq.FakeQuantizeBase):
+            # 7 bits on fbgemm, as the calibration observers
+            shared = tq.FakeQuantize(observer=tq.MinMaxObserver, quant_min=0,
+                                     quant_max=127 if backend == 'fbgemm' else 255,
+                                     dtype=torch.quint8, qscheme=torch.per_tensor_affine)
+        else:
+            shared = model.qconfig.activation()
+        for m in group:
+            m.activation_post_process = shared
+    return model
+
+
+def save_calibration(model, filename, source=None):
+    """Writes the activation observers, with source, the digest of the checkpoint they were calibrated on"""
+    torch.save({'checkpoint': source,
+                'observers': dict((name, {'observer': type(m).__name__, 'state_dict': m.state_dict()})
+                                  for name, m in activation_observers(model).items())}, filename)
+
+
+def load_calibration(model, filename, source=None):
+    """Restores the observers of a prepared model.
+
+    False if the cache does not cover all of them or was calibrated on another
+    checkpoint than the one with digest source (or on an unknown one).
+    """
+    cache = torch.load(filename, map_location=torch.device('cpu'))
+    if source is None or cache.get('checkpoint') != source:
+        return False
+    cache = cache['observers']
+    observers = activation_observers(model)
+    for name, m in observers.items():
+        if name not in cache or cache[name]['observer'] != type(m).__name__:
+            return False
+    for name, m in observers.items():
+        m.load_state_dict(cache[name]['state_dict'])
+    return True
+
+
+def prepare(model, backend='fbgemm'):
+    """Fuses model in place and inserts the observers"""
+    torch.backends.quantized.engine = backend
+    model.eval()
+    model.fuse()
+    model.qconfig = qconfig(backend)
+    tq.prepare(model, inplace=True)
+    return model
+
+
+def prepare_qat(model, backend='fbgemm', shared_concat=False):
+    """Fuses model in place in training mode and inserts fake quantization"""
+    torch.backends.quantized.engine = backend
+    model.train()
+    model.fuse(qat=True)
+    model.qconfig = tq.get_default_qat_qconfig(backend)
+    tq.prepare_qat(model, inplace=True)
+    if shared_concat:
+        share_concat_observers(model, backend)
+    return model
+
+
+def qat_freeze(model, epoch, num_epochs):
+    """Freezes the BatchNorm statistics for the second half of QAT and the observers an epoch later.
+
+    The last epochs then train the weights against fixed scales and the
+    statistics that the converted convs will fold in.
+    """
+    if epoch >= num_epochs // 2:
+        model.apply(nniqat.freeze_bn_stats)
+    if epoch >= num_epochs // 2 + 1:
+        model.apply(tq.disable_observer)
+
+
+@contextlib.contextmanager
+def observers_frozen(model):
+    """Keeps the fake quantization ranges of a QAT model fixed inside the block.
+
+    FakeQuantize observes in eval mode too: validation data would otherwise move
+    the scales. The observers come back as they were, frozen or not.
+    """
+    fake_quants = [m for m in model.modules() if isinstance(m, tq.FakeQuantizeBase)]
+    enabled = [m.observer_enabled.clone() for m in fake_quants]
+    model.apply(tq.disable_observer)
+    try:
+        yield model
+    finally:
+        for m, e in zip(fake_quants, enabled):
+            m.observer_enabled.copy_(e)
+
+
+def convert(model, backend='fbgemm'):
+    tq.convert(model, inplace=True)
+    model.config['qbackend'] = backend
+    return model
+
+
+def calibrate(model, batches):
+    with torch.no_grad():
+        for input in batches:
+            model(input)
+
+
+def quantize(model, batches, backend='fbgemm', cache='', shared_concat=False, source=None):
+    """Quantizes model in place.
+
+    Args:
+        batches (iterable of tensors) - calibration inputs, only consumed when the cache misses
+        cache (str) - calibration cache file, read if it exists and written after calibrating
+        shared_concat (bool) - one scale per concat group, see share_concat_observers
+        source (str) - compiled.file_digest of the checkpoint model was loaded from, a cache
+          written for another checkpoint is a miss
+    """
+    prepare(model, backend)
+    if shared_concat:
+        share_concat_observers(model, backend)
+    if cache and os.path.isfile(cache) and load_calibration(model, cache, source):
+        print("=> loaded calibration from '{}'".format(cache))
+    else:
+        calibrate(model, batches)
+        if cache:
+            save_calibration(model, cache, source)
+            print("=> saved calibration to '{}'".format(cache))
+    return convert(model, backend)
+
+
+def quantized_structure(model, backend):
+    """Turns a freshly built model into the int8 structure that a saved state_dict loads into"""
+    # the observers see no data: the scales and the packed weights all come from the state_dict
+    prepare(model, backend)
+    return convert(model, backend)
+
+
+def loader_batches(loader, num_batches, memory_format=torch.contiguous_format):
+    """Inputs of the first num_batches batches of a classification loader"""
+    for input, _ in itertools.islice(loader, num_batches):
+        yield input.contiguous(memory_format=memory_format)
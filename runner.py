@@ -0,0 +1,257 @@
+"""Multi-instance, NUMA-aware PeleeNet throughput runner.
+
+Small conv layers do not scale to a whole socket, so instead of one model with
+28 threads this runs N model instances, each in its own process pinned to a
+group of physical cores on one NUMA node with its memory bound to that node.
+All instances consume from one shared request queue.
+
+Usage: python runner.py --instances 4 --threads 7 [-b 1] [--requests 2000] [--weights PATH]
+       python runner.py --sweep [-b 1]
+"""
+import argparse
+import ctypes
+import ctypes.util
+import glob
+import multiprocessing
+import os
+import queue
+import re
+import time
+
+import torch
+
+import compiled
+from peleenet import PeleeNet, load_model
+from profiling import percentile
+
+parser = argparse.ArgumentParser(description='PeleeNet multi-instance throughput runner')
+parser.add_argument('--instances', default=0, type=int, metavar='N',
+                    help='model instances (default: one per NUMA node)')
+parser.add_argument('--threads', default=0, type=int, metavar='N',
+                    help='threads per instance (default: all cores of the node / instances per node)')
+parser.add_argument('--nodes', default='', type=str,
+                    help='comma separated NUMA nodes to use (default: all)')
+parser.add_argument('-b', '--batch-size', default=1, type=int, metavar='N',
+                    help='batch size of every request (default: 1)')
+parser.add_argument('--input-dim', default=224, type=int,
+                    help='size of the input dimension (default: 224)')
+parser.add_argument('--requests', default=2000, type=int, metavar='N',
+                    help='requests to run (default: 2000)')
+parser.add_argument('--warmup', default=10, type=int, metavar='N',
+                    help='warmup iterations per instance (default: 10)')
+parser.add_argument('--weights', default='', type=str, metavar='PATH',
+                    help='checkpoint, optimized model or TorchScript artifact (default: random weights)')
+parser.add_argument('--model', default='optimized', choices=['eager', 'optimized', 'jit'],
+                    help='eager | optimized | jit (default: optimized)')
+parser.add_argument('--sweep', action='store_true',
+                    help='try every instances x threads split of the cores and report the best')
+
+
+def parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_topology():
+    """{node: [physical core ids]} with one logical cpu per physical core"""
+    available = os.sched_getaffinity(0)
+    nodes = {}
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*')):
+        node = int(re.search(r'node(\d+)$', path).group(1))
+        with open(os.path.join(path, 'cpulist')) as f:
+            nodes[node] = [c for c in parse_cpulist(f.read()) if c in available]
+    if not nodes:
+        nodes = {0: sorted(available)}
+
+    for node, cpus in nodes.items():
+        physical = []
+        seen = set()
+        for cpu in cpus:
+            try:
+                with open('/sys/devices/system/cpu/cpu{}/topology/thread_siblings_list'.format(cpu)) as f:
+                    siblings = tuple(parse_cpulist(f.read()))
+            except IOError:
+                siblings = (cpu,)
+            if siblings not in seen:
+                seen.add(siblings)
+                physical.append(cpu)
+        nodes[node] = physical
+    return dict((n, c) for n, c in nodes.items() if c)
+
+
+def plan(topology, instances, threads):
+    """[(node, cores)] per instance, never splitting an instance across nodes"""
+    nodes = sorted(topology)
+    if instances <= 0:
+        instances = len(nodes)
+    per_node = [instances // len(nodes) + (1 if i < instances % len(nodes) else 0) for i in range(len(nodes))]
+
+    layout = []
+    for node, count in zip(nodes, per_node):
+        cores = topology[node]
+        if count == 0:
+            continue
+        n = threads if threads > 0 else len(cores) // count
+        if n * count > len(cores) or n == 0:
+            raise ValueError('node {} has {} cores, cannot fit {} instances x {} threads'.format(
+                node, len(cores), count, n))
+        for i in range(count):
+            layout.append((node, cores[i * n:(i + 1) * n]))
+    return layout
+
+
+def load_libnuma():
+    """libnuma through ctypes, None when it is not installed.
+
+    find_library runs a subprocess: load it before forking, never in a preexec_fn.
+    """
+    name = ctypes.util.find_library('numa')
+    if name is None:
+        return None
+    try:
+        libnuma = ctypes.CDLL(name)
+        libnuma.numa_parse_nodestring.restype = ctypes.c_void_p
+        libnuma.numa_set_membind.argtypes = [ctypes.c_void_p]
+        return libnuma
+    except (OSError, AttributeError):
+        return None
+
+
+def node_mask(libnuma, node):
+    """The libnuma node mask of node, None if libnuma does not know it"""
+    return libnuma.numa_parse_nodestring(str(node).encode()) or None
+
+
+def bind_memory(node):
+    # libnuma is optional: without it, pinning plus first-touch allocation
+    # keeps most pages on the local node anyway
+    libnuma = load_libnuma()
+    if libnuma is None:
+        return False
+    mask = node_mask(libnuma, node)
+    if mask is None:
+        return False
+    libnuma.numa_set_membind(mask)
+    return True
+
+
+def build_model(weights, kind, example):
+    if kind == 'jit':
+        return compiled.load(weights, example)
+    model = load_model(weights) if weights else PeleeNet()
+    model.eval()
+    if kind == 'optimized':
+        model.optimize_for_inference()
+    return model
+
+
+def worker(rank, node, cores, args, requests, results):
+    os.sched_setaffinity(0, cores)
+    bind_memory(node)
+    torch.set_num_threads(len(cores))
+
+    input = torch.randn(args.batch_size, 3, args.input_dim, args.input_dim)
+    model = build_model(args.weights, args.model, input)
+    with torch.no_grad():
+        for _ in range(args.warmup):
+            model(input)
+        results.put(('ready', rank, None))
+
+        latencies = []
+        while True:
+            item = requests.get()
+            if item is None:
+                break
+            t0 = time.perf_counter()
+            model(input)
+            latencies.append(time.perf_counter() - t0)
+    results.put(('done', rank, latencies))
+
+
+def collect(results, procs, poll=1.0):
+    """Next item of results; if a worker dies first, terminates the others and raises.
+
+    A worker killed by the OOM killer, or failing in bind_memory or build_model,
+    never reports, and a plain results.get() would wait for it forever.
+    """
+    while True:
+        try:
+            return results.get(timeout=poll)
+        except queue.Empty:
+            pass
+        for rank, p in enumerate(procs):
+            if not p.is_alive() and p.exitcode != 0:
+                for other in procs:
+                    if other.is_alive():
+                        other.terminate()
+                reason = 'signal {}'.format(-p.exitcode) if p.exitcode < 0 else 'exit code {}'.format(p.exitcode)
+                raise RuntimeError('rank {} (pid {}) died with {}'.format(rank, p.pid, reason))
+
+
+def run(args, layout, verbose=True):
+    ctx = multiprocessing.get_context('spawn')
+    requests = ctx.Queue()
+    results = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(rank, node, cores, args, requests, results))
+             for rank, (node, cores) in enumerate(layout)]
+    for p in procs:
+        p.start()
+    for _ in procs:
+        collect(results, procs)
+
+    start = time.perf_counter()
+    for i in range(args.requests):
+        requests.put(i)
+    for _ in procs:
+        requests.put(None)
+    latencies = {}
+    for _ in procs:
+        _, rank, values = collect(results, procs)
+        latencies[rank] = values
+    elapsed = time.perf_counter() - start
+    for p in procs:
+        p.join()
+
+    throughput = args.requests * args.batch_size / elapsed
+    if verbose:
+        for rank, (node, cores) in enumerate(layout):
+            values = latencies[rank]
+            print('  instance {:2d} node {} cores {:>9s}: {:5d} requests, p50 {:.2f} ms, p99 {:.2f} ms'.format(
+                rank, node, '{}-{}'.format(cores[0], cores[-1]), len(values),
+                1e3 * percentile(values, 50), 1e3 * percentile(values, 99)))
+        print('{} instances x {} threads: {:.1f} images/s'.format(len(layout), len(layout[0][1]), throughput))
+    return throughput
+
+
+def main():
+    args = parser.parse_args()
+    topology = numa_topology()
+    if args.nodes:
+        topology = dict((n, topology[n]) for n in (int(v) for v in args.nodes.split(',')))
+    print('=> topology: ' + ', '.join('node {}: {} cores'.format(n, len(c)) for n, c in sorted(topology.items())))
+
+    if not args.sweep:
+        run(args, plan(topology, args.instances, args.threads))
+        return
+
+    cores_per_node = min(len(c) for c in topology.values())
+    results = []
+    for threads in [t for t in range(cores_per_node, 0, -1) if cores_per_node % t == 0]:
+        instances = len(topology) * (cores_per_node // threads)
+        throughput = run(args, plan(topology, instances, threads), verbose=False)
+        print('{:3d} instances x {:2d} threads: {:.1f} images/s'.format(instances, threads, throughput))
+        results.append((throughput, instances, threads))
+    best = max(results)
+    print('=> best: {} instances x {} threads, {:.1f} images/s'.format(best[1], best[2], best[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Dynamic-batching PeleeNet inference server.
+
+Single-image requests are queued and grouped into micro-batches bounded by a
+maximum batch size and a maximum queueing delay, then run on a worker pool.
+The front end is a small asyncio HTTP/1.1 server on TCP or a Unix socket:
+
+    POST /predict[?topk=5]   body: encoded image  ->  {"classes": [...], "probs": [...]}
+    GET  /metrics                                 ->  queue depth, batch sizes, latency percentiles
+
+Usage: python server.py --weights checkpoint.pth.tar [--model optimized] [--max-batch-size 32]
+                        [--max-delay-ms 5] [--port 8080 | --unix-socket /tmp/peleenet.sock]
+"""
+import argparse
+import asyncio
+import collections
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from PIL import Image
+
+import compiled
+from bucketing import ModelInput
+from peleenet import load_model
+from profiling import percentile
+
+parser = argparse.ArgumentParser(description='PeleeNet dynamic-batching inference server')
+parser.add_argument('--weights', required=True, type=str, metavar='PATH',
+                    help='main.py checkpoint, optimized model or TorchScript artifact')
+parser.add_argument('--model', default='eager', choices=['eager', 'optimized', 'jit'],
+                    help='eager | optimized (optimize_for_inference) | jit (a compiled fp32 or int8 '
+                         'artifact, see main.py --jit) (default: eager)')
+parser.add_argument('--input-dim', default=224, type=int,
+                    help='size of the input dimension (default: 224)')
+parser.add_argument('--max-batch-size', default=32, type=int, metavar='N',
+                    help='largest micro-batch (default: 32)')
+parser.add_argument('--max-delay-ms', default=5.0, type=float, metavar='MS',
+                    help='longest time the first request of a batch waits for others (default: 5)')
+parser.add_argument('--workers', default=1, type=int, metavar='N',
+                    help='batches run concurrently (default: 1)')
+parser.add_argument('--decode-workers', default=4, type=int, metavar='N',
+                    help='threads decoding and preprocessing images (default: 4)')
+parser.add_argument('--threads', default=0, type=int, metavar='N',
+                    help='torch intra-op threads, 0 keeps the default')
+parser.add_argument('--host', default='127.0.0.1', type=str)
+parser.add_argument('--port', default=8080, type=int)
+parser.add_argument('--unix-socket', default='', type=str, metavar='PATH',
+                    help='listen on a Unix socket instead of TCP')
+
+
+class Metrics(object):
+    """Batch size histogram and a window of recent request latencies"""
+    def __init__(self, window=10000):
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+
+    def record_batch(self, size):
+        self.batch_sizes[size] += 1
+
+    def record_latency(self, seconds):
+        self.requests += 1
+        self.latencies.append(seconds)
+
+    def summary(self, queue_depth):
+        def latency(p):
+            # null in the JSON until there are requests
+            return 1000.0 * percentile(self.latencies, p) if self.latencies else None
+
+        return {
+            'requests': self.requests,
+            'queue_depth': queue_depth,
+            'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            'latency_ms': {'p50': latency(50), 'p90': latency(90), 'p99': latency(99)},
+        }
+
+
+class DynamicBatcher(object):
+    """Collects requests into micro-batches and runs them on a thread pool.
+
+    At most `workers` batches are in flight, so under load the queue grows and
+    the next batch fills up instead of running many small ones.
+    """
+    def __init__(self, model, max_batch_size=32, max_delay=0.005, workers=1):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = asyncio.Semaphore(workers)
+        self.queue = asyncio.Queue()
+        self.metrics = Metrics()
+
+    async def submit(self, input):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((input, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # wait for a free worker first: requests arriving meanwhile join this batch
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_delay
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = loop.run_in_executor(self.pool, self._forward, [item[0] for item in batch])
+            task.add_done_callback(lambda t, batch=batch: self._complete(t, batch))
+            self.metrics.record_batch(len(batch))
+
+    def _forward(self, inputs):
+        with torch.no_grad():
+            return F.softmax(self.model(torch.stack(inputs)), dim=1)
+
+    def _complete(self, task, batch):
+        self.slots.release()
+        now = time.perf_counter()
+        error = task.exception()
+        for i, (_, future, start) in enumerate(batch):
+            if future.cancelled():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(task.result()[i])
+                self.metrics.record_latency(now - start)
+
+
+class Server(object):
+    def __init__(self, batcher, input_dim=224, decode_workers=4, input_norm=None):
+        self.batcher = batcher
+        self.decoder = ThreadPoolExecutor(max_workers=decode_workers)
+        self.crop = transforms.Compose([
+            transforms.Resize(input_dim + 32),
+            transforms.CenterCrop(input_dim),
+        ])
+        # normalized float, or uint8 pixels for a model saved with the normalization folded in
+        self.to_input = ModelInput(input_norm)
+
+    def preprocess(self, data):
+        return self.to_input(self.crop(Image.open(io.BytesIO(data)).convert('RGB')))
+
+    async def predict(self, body, topk):
+        input = await asyncio.get_running_loop().run_in_executor(self.decoder, self.preprocess, body)
+        prob = await self.batcher.submit(input)
+        values, classes = prob.topk(topk)
+        return {'classes': classes.tolist(), 'probs': values.tolist()}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                url = urlparse(target)
+                try:
+                    if method == 'POST' and url.path == '/predict':
+                        topk = int(parse_qs(url.query).get('topk', ['5'])[0])
+                        status, payload = 200, await self.predict(body, topk)
+                    elif method == 'GET' and url.path == '/metrics':
+                        status, payload = 200, self.batcher.metrics.summary(self.batcher.queue.qsize())
+                    else:
+                        status, payload = 404, {'error': 'not found'}
+                except Exception as e:
+                    status, payload = 500, {'error': str(e)}
+
+                data = json.dumps(payload).encode()
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                             .format(status, 'OK' if status == 200 else 'Error', len(data)).encode() + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def build_model(args):
+    """(warmed-up model, its input_norm config)"""
+    if args.model == 'jit':
+        # a frozen graph no longer has input_norm, the artifact records it
+        model, input_norm = compiled.load_artifact(args.weights)
+    else:
+        model = load_model(args.weights).eval()
+        if args.model == 'optimized':
+            model.optimize_for_inference()
+        input_norm = model.config.get('input_norm')
+    to_input = ModelInput(input_norm)
+    example = torch.zeros((1,) + to_input.shape(args.input_dim, args.input_dim), dtype=to_input.dtype)
+    return compiled.warmup(model, example), input_norm
+
+
+async def serve(args):
+    model, input_norm = build_model(args)
+    batcher = DynamicBatcher(model, max_batch_size=args.max_batch_size,
+                             max_delay=args.max_delay_ms / 1000.0, workers=args.workers)
+    server = Server(batcher, input_dim=args.input_dim, decode_workers=args.decode_workers,
+                    input_norm=input_norm)
+
+    if args.unix_socket:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix_socket)
+        print('=> serving on {}'.format(args.unix_socket))
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        print('=> serving on http://{}:{}'.format(args.host, args.port))
+
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), batcher.run())
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    asyncio.run(serve(args))
+
+
+if __name__ == '__main__':
+    main()
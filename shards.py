@@ -0,0 +1,181 @@
+"""Sharded sequential-read image dataset.
+
+`pack` turns ImageFolder trees into a few large shard files per split, each
+holding the encoded images back to back with an index of (offset, length,
+label). ShardDataset streams them with sequential reads and a shuffle buffer
+instead of 1.28M random small-file reads per epoch, and splits the samples
+evenly across DDP ranks and DataLoader workers.
+
+Layout:  OUT/<split>/meta.json, OUT/<split>/shard-NNNNN.bin, OUT/<split>/shard-NNNNN.idx.npy
+
+Usage: python shards.py DATA OUT [--splits train,val] [--shard-size-mb 1024]
+"""
+import argparse
+import bisect
+import io
+import json
+import os
+import random
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torchvision.datasets as datasets
+from PIL import Image
+
+parser = argparse.ArgumentParser(description='Pack ImageFolder splits into shards')
+parser.add_argument('data', metavar='DIR', help='path to dataset')
+parser.add_argument('out', metavar='OUT', help='output directory')
+parser.add_argument('--splits', default='train,val', type=str,
+                    help='comma separated sub-folders to pack (default: train,val)')
+parser.add_argument('--shard-size-mb', default=1024, type=int, metavar='MB',
+                    help='target size of one shard (default: 1024)')
+parser.add_argument('--seed', default=0, type=int,
+                    help='seed of the packing order (default: 0)')
+
+
+def pack(folder, out_dir, shard_size=1 << 30, seed=0):
+    """Writes the images of an ImageFolder tree into shards, in a shuffled order"""
+    dataset = datasets.ImageFolder(folder)
+    samples = list(dataset.samples)
+    # mix the classes once at pack time, the loader only shuffles within a buffer
+    random.Random(seed).shuffle(samples)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    shards = []
+
+    def flush(data, index):
+        name = 'shard-{:05d}'.format(len(shards))
+        with open(os.path.join(out_dir, name + '.bin'), 'wb') as f:
+            f.write(data.getvalue())
+        np.save(os.path.join(out_dir, name + '.idx.npy'), np.array(index, dtype=np.int64).reshape(-1, 3))
+        shards.append({'name': name, 'count': len(index)})
+        print("=> wrote '{}' ({} images)".format(name, len(index)))
+
+    data, index = io.BytesIO(), []
+    for path, label in samples:
+        with open(path, 'rb') as f:
+            encoded = f.read()
+        index.append((data.tell(), len(encoded), label))
+        data.write(encoded)
+        if data.tell() >= shard_size:
+            flush(data, index)
+            data, index = io.BytesIO(), []
+    if index:
+        flush(data, index)
+
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'classes': dataset.classes, 'count': len(samples), 'shards': shards}, f)
+
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    """Streams (image, label) pairs from the shards of one split.
+
+    Every epoch the shard order is permuted (with shuffle), then the sample
+    stream is cut into equal contiguous ranges per rank and per worker, so all
+    ranks see the same number of samples and every reader moves forward
+    through its files. Samples are shuffled inside a buffer of shuffle_buffer.
+
+    Args:
+        distributed (bool) - split the samples across the ranks of the default process group
+        drop_last (bool) - drop the count % world_size samples left over by the equal split;
+          without it the ranks differ by at most one sample (for evaluation)
+    """
+    def __init__(self, root, transform=None, shuffle=True, shuffle_buffer=10000, seed=0, distributed=True,
+                 drop_last=True):
+        self.root = root
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.drop_last = drop_last
+        with open(os.path.join(root, 'meta.json')) as f:
+            meta = json.load(f)
+        self.classes = meta['classes']
+        self.shards = meta['shards']
+        self.count = meta['count']
+
+        if distributed and dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            self.rank, self.world_size = 0, 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        start, end = self._rank_range()
+        return end - start
+
+    def _rank_range(self):
+        if self.drop_last:
+            per_rank = self.count // self.world_size
+            return self.rank * per_rank, (self.rank + 1) * per_rank
+        return self.count * self.rank // self.world_size, self.count * (self.rank + 1) // self.world_size
+
+    def _range(self):
+        start, end = self._rank_range()
+        per_rank = end - start
+        worker = torch.utils.data.get_worker_info()
+        if worker is None:
+            return start, start + per_rank
+        return (start + per_rank * worker.id // worker.num_workers,
+                start + per_rank * (worker.id + 1) // worker.num_workers)
+
+    def _records(self, shards, start, end):
+        offsets = np.cumsum([0] + [s['count'] for s in shards])
+        first = bisect.bisect_right(offsets, start) - 1
+        for i in range(first, len(shards)):
+            if offsets[i] >= end:
+                break
+            index = np.load(os.path.join(self.root, shards[i]['name'] + '.idx.npy'))
+            lo = max(start - offsets[i], 0)
+            hi = min(end - offsets[i], len(index))
+            with open(os.path.join(self.root, shards[i]['name'] + '.bin'), 'rb', buffering=8 << 20) as f:
+                f.seek(int(index[lo, 0]))
+                for offset, length, label in index[lo:hi]:
+                    yield f.read(int(length)), int(label)
+
+    def _shuffled(self, records, rng):
+        buffer = []
+        for record in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = record
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield record
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        shards = list(self.shards)
+        if self.shuffle:
+            rng.shuffle(shards)
+        start, end = self._range()
+        records = self._records(shards, start, end)
+        if self.shuffle:
+            worker = torch.utils.data.get_worker_info()
+            records = self._shuffled(records, random.Random(
+                (self.seed + self.epoch) * 1000003 + self.rank * 1009 + (worker.id if worker else 0)))
+
+        for data, label in records:
+            image = Image.open(io.BytesIO(data)).convert('RGB')
+            if self.transform is not None:
+                image = self.transform(image)
+            yield image, label
+
+
+def main():
+    args = parser.parse_args()
+    for split in args.splits.split(','):
+        pack(os.path.join(args.data, split), os.path.join(args.out, split),
+             shard_size=args.shard_size_mb << 20, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from peleenet import PeleeNet
+
+
+def small_peleenet(**kwargs):
+    """A seeded PeleeNet small enough for CPU tests, with non-trivial BatchNorm statistics"""
+    torch.manual_seed(0)
+    model = PeleeNet(growth_rate=16, block_config=[1, 2, 2, 1], num_init_features=16,
+                     bottleneck_width=[1, 2, 2, 2], num_classes=10, **kwargs)
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.weight.uniform_(0.5, 1.5)
+                m.bias.uniform_(-0.1, 0.1)
+                m.running_mean.uniform_(-0.1, 0.1)
+                m.running_var.uniform_(0.5, 1.5)
+    return model.eval()
+
+
+@pytest.fixture
+def model():
+    return small_peleenet()
+
+
+@pytest.fixture(params=['contiguous', 'channels_last'])
+def memory_format(request):
+    return {'contiguous': torch.contiguous_format, 'channels_last': torch.channels_last}[request.param]
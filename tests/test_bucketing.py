@@ -0,0 +1,17 @@
+from bucketing import assign_bucket
+
+BUCKETS = [(160, 160), (224, 224), (288, 288), (192, 256), (256, 192)]
+
+
+def test_small_image_gets_the_smallest_bucket():
+    assert assign_bucket(BUCKETS, 100, 100) == (160, 160)
+
+
+def test_image_is_downscaled_to_the_largest_bucket_it_covers():
+    assert assign_bucket(BUCKETS, 250, 250) == (224, 224)
+    assert assign_bucket(BUCKETS, 1000, 1000) == (288, 288)
+
+
+def test_aspect_ratio_comes_first():
+    assert assign_bucket(BUCKETS, 300, 400) == (192, 256)
+    assert assign_bucket(BUCKETS, 400, 300) == (256, 192)
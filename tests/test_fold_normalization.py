@@ -0,0 +1,32 @@
+import copy
+
+import pytest
+import torch
+
+MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+STD = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+
+def pixels():
+    torch.manual_seed(1)
+    return torch.randint(0, 256, (2, 3, 64, 64), dtype=torch.uint8)
+
+
+@pytest.mark.parametrize('fused', [False, True], ids=['batchnorm', 'fused-bias'])
+@pytest.mark.parametrize('channels_last', [False, True], ids=['nchw', 'nhwc'])
+def test_uint8_model_matches_normalized_float_input(model, fused, channels_last):
+    if fused:
+        # BatchNorm is folded into the conv: the shift goes into the conv bias
+        model.fuse()
+    x = pixels()
+    with torch.no_grad():
+        expected = model((x.float() / 255 - MEAN) / STD)
+
+    folded = copy.deepcopy(model).fold_normalization(channels_last=channels_last)
+    if channels_last:
+        folded = folded.to(memory_format=torch.channels_last)
+        x = x.permute(0, 2, 3, 1).contiguous()
+    with torch.no_grad():
+        actual = folded(x)
+
+    assert torch.allclose(actual, expected, rtol=1e-4, atol=1e-4), (actual - expected).abs().max()
@@ -0,0 +1,59 @@
+import copy
+
+import torch
+
+from peleenet import _DenseBlock, _DenseLayer
+
+
+def outputs(model, memory_format, input=None):
+    if input is None:
+        torch.manual_seed(1)
+        input = torch.randn(2, 3, 64, 64)
+    model = model.to(memory_format=memory_format)
+    with torch.no_grad():
+        return model(input.contiguous(memory_format=memory_format))
+
+
+def assert_same_logits(reference, rewritten, memory_format):
+    expected = outputs(reference, memory_format)
+    actual = outputs(rewritten, memory_format)
+    assert torch.allclose(actual, expected, rtol=1e-4, atol=1e-5), (actual - expected).abs().max()
+
+
+def test_merge_branches(model, memory_format):
+    merged = copy.deepcopy(model)
+    for m in merged.modules():
+        if isinstance(m, _DenseLayer):
+            m.merge_branches()
+            assert m.branch_a is not None
+    assert_same_logits(model, merged, memory_format)
+
+
+def test_fuse(model, memory_format):
+    fused = copy.deepcopy(model)
+    fused.fuse()
+    assert_same_logits(model, fused, memory_format)
+
+
+def test_optimize_for_inference(model, memory_format):
+    assert_same_logits(model, copy.deepcopy(model).optimize_for_inference(), memory_format)
+
+
+def test_optimize_for_inference_without_head_fold(model, memory_format):
+    assert_same_logits(model, copy.deepcopy(model).optimize_for_inference(fold_head=False), memory_format)
+
+
+def test_shared_buffer(model, memory_format):
+    shared = copy.deepcopy(model)
+    for m in shared.modules():
+        if isinstance(m, _DenseBlock):
+            m.shared_buffer = True
+    assert_same_logits(model, shared, memory_format)
+
+
+def test_shared_buffer_with_optimize_for_inference(model, memory_format):
+    shared = copy.deepcopy(model).optimize_for_inference()
+    for m in shared.modules():
+        if isinstance(m, _DenseBlock):
+            m.shared_buffer = True
+    assert_same_logits(model, shared, memory_format)
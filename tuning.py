@@ -0,0 +1,112 @@
+"""Fast accuracy evaluation for ilit int8 tuning.
+
+The evaluation batches and the FP32 logits are computed once. Every trial then
+only runs the candidate over the cached inputs and scores it, by default by
+top-1 agreement with the FP32 model, whose own score is 1 by definition. A
+trial stops as soon as even a perfect rest of the set could not reach the
+accuracy criterion of the ilit config, and reports that upper bound, which
+ilit rejects.
+
+Usage: tuner.tune(model, evaluator.loader, eval_func=evaluator) with
+       evaluator = CachedEvaluator(fp32_model, val_loader, criterion=accuracy_criterion('config.yaml'))
+"""
+import itertools
+import time
+
+import torch
+
+
+def _items(section):
+    if section is None:
+        return []
+    return section if isinstance(section, list) else [section]
+
+
+def accuracy_criterion(config):
+    """('relative' or 'absolute', value) of the tuning section of an ilit config.yaml"""
+    import yaml
+    with open(config) as f:
+        tuning = yaml.safe_load(f).get('tuning')
+    for section in _items(tuning):
+        for criterion in _items(section.get('accuracy_criterion')):
+            for kind in ('relative', 'absolute'):
+                if kind in criterion:
+                    return kind, float(criterion[kind])
+    return 'relative', 0.01
+
+
+class CachedBatches(object):
+    """The cached (input, target) batches, iterable like the DataLoader they came from"""
+    def __init__(self, batches, batch_size):
+        self.batches = batches
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class CachedEvaluator(object):
+    """eval_func for ilit over batches and FP32 logits cached at construction.
+
+    Args:
+        model - the FP32 model giving the reference logits
+        loader - (input, target) batches in random order, read once
+        num_batches (int) - batches to cache in memory as float tensors, None for all of loader
+        metric (str) - 'agreement' with the FP32 top-1 or 'top1' against the labels
+        criterion (tuple) - ('relative' or 'absolute', value) as in the ilit config
+    """
+    def __init__(self, model, loader, num_batches=None, metric='agreement', criterion=('relative', 0.01),
+                 memory_format=torch.contiguous_format):
+        assert metric in ('agreement', 'top1')
+        self.metric = metric
+        batches = []
+        self.logits = []
+        model.eval()
+        with torch.no_grad():
+            for input, target in itertools.islice(loader, num_batches):
+                input = input.contiguous(memory_format=memory_format)
+                batches.append((input, target))
+                self.logits.append(model(input).float())
+        self.loader = CachedBatches(batches, getattr(loader, 'batch_size', batches[0][0].size(0)))
+        self.count = sum(target.size(0) for _, target in batches)
+
+        if metric == 'agreement':
+            self.references = [logits.argmax(1) for logits in self.logits]
+            baseline = 1.0
+        else:
+            self.references = [target for _, target in batches]
+            baseline = sum((logits.argmax(1) == target).sum().item()
+                           for logits, (_, target) in zip(self.logits, batches)) / float(self.count)
+        kind, value = criterion
+        self.baseline = baseline
+        self.target = baseline * (1 - value) if kind == 'relative' else baseline - value
+
+        self.trials = 0
+        self.stopped = 0
+        self.seconds = 0.0
+
+    def __call__(self, model):
+        self.trials += 1
+        start = time.time()
+        model.eval()
+        hits = seen = 0
+        with torch.no_grad():
+            for (input, _), reference in zip(self.loader, self.references):
+                hits += (model(input).argmax(1) == reference).sum().item()
+                seen += reference.size(0)
+                # the best this trial can still score, with every remaining sample a hit
+                bound = (hits + self.count - seen) / float(self.count)
+                if bound < self.target:
+                    self.stopped += 1
+                    self.seconds += time.time() - start
+                    return bound
+        self.seconds += time.time() - start
+        return hits / float(self.count)
+
+    def __str__(self):
+        return '{} trials on {} cached images, {} stopped early, {:.1f}s evaluating ({} baseline {:.4f}, ' \
+               'target {:.4f})'.format(self.trials, self.count, self.stopped, self.seconds, self.metric,
+                                       self.baseline, self.target)
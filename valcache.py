@@ -0,0 +1,153 @@
+"""Memory-mapped, pre-decoded ImageNet validation set.
+
+The validation images are decoded, resized to input_dim + 32 and center-cropped
+once, then stored as one uint8 NHWC array (.npy, memory-mapped) keyed by
+input_dim, with the labels and class names alongside. The images are stored in
+a seeded random order, so that any contiguous range, the first N images or a
+rank's share, mixes all the classes. Loading a batch is a slice of that array:
+no JPEG decoding and no DataLoader worker processes.
+
+Usage: python valcache.py DATA --cache-dir val_cache [--input-dim 224] [-j 16]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+import torchvision.datasets as datasets
+import torchvision.transforms as transforms
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+parser = argparse.ArgumentParser(description='Build the pre-decoded validation cache')
+parser.add_argument('data', metavar='DIR', help='path to dataset (the val folder is used)')
+parser.add_argument('--cache-dir', default='val_cache', type=str, metavar='DIR',
+                    help='where to write the cache (default: val_cache)')
+parser.add_argument('--input-dim', default=224, type=int,
+                    help='size of the input dimension (default: 224)')
+parser.add_argument('-j', '--workers', default=16, type=int, metavar='N',
+                    help='number of decoding processes (default: 16)')
+parser.add_argument('--seed', default=0, type=int, help='seed of the storage order (default: 0)')
+
+
+def cache_files(cache_dir, input_dim):
+    prefix = os.path.join(cache_dir, 'val_{}'.format(input_dim))
+    return prefix + '_images.npy', prefix + '_labels.npy', prefix + '.json'
+
+
+def exists(cache_dir, input_dim):
+    if not all(os.path.isfile(f) for f in cache_files(cache_dir, input_dim)):
+        return False
+    with open(cache_files(cache_dir, input_dim)[2]) as f:
+        # caches written in class order, before the shuffled layout, are rebuilt
+        return 'seed' in json.load(f)
+
+
+class _Decode(object):
+    def __init__(self, input_dim):
+        self.transform = transforms.Compose([
+            transforms.Resize(input_dim + 32),
+            transforms.CenterCrop(input_dim),
+        ])
+
+    def __call__(self, path):
+        return np.asarray(self.transform(datasets.folder.default_loader(path)), dtype=np.uint8)
+
+
+def build(valdir, cache_dir, input_dim, workers=16, seed=0):
+    """Decodes valdir once into the cache for input_dim, in an order shuffled with seed"""
+    dataset = datasets.ImageFolder(valdir)
+    samples = [dataset.samples[i] for i in np.random.RandomState(seed).permutation(len(dataset))]
+    images_file, labels_file, meta_file = cache_files(cache_dir, input_dim)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    tmp = images_file + '.tmp'
+    images = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8,
+                                       shape=(len(dataset), input_dim, input_dim, 3))
+    paths = [path for path, _ in samples]
+    with multiprocessing.Pool(workers) as pool:
+        for i, image in enumerate(pool.imap(_Decode(input_dim), paths, chunksize=64)):
+            images[i] = image
+            if i % 5000 == 0:
+                print('=> decoded {}/{}'.format(i, len(paths)))
+    images.flush()
+    del images
+    os.replace(tmp, images_file)
+
+    np.save(labels_file, np.array([label for _, label in samples], dtype=np.int64))
+    with open(meta_file, 'w') as f:
+        json.dump({'classes': dataset.classes, 'input_dim': input_dim, 'count': len(dataset), 'seed': seed}, f)
+    print("=> wrote {} images to '{}'".format(len(dataset), images_file))
+
+
+def normalize(images):
+    """uint8 NHWC batch to the float NCHW input of the ImageFolder transforms"""
+    mean = torch.tensor(MEAN).view(1, 3, 1, 1) * 255
+    std = torch.tensor(STD).view(1, 3, 1, 1) * 255
+    return images.permute(0, 3, 1, 2).float().sub_(mean).div_(std)
+
+
+class MemmapDataset(torch.utils.data.Dataset):
+    """Per-image access to the cache, for code that needs a regular Dataset"""
+    def __init__(self, cache_dir, input_dim, raw=False):
+        images_file, labels_file, meta_file = cache_files(cache_dir, input_dim)
+        # copy-on-write keeps the pages shared while giving torch a writable array
+        self.images = np.load(images_file, mmap_mode='c')
+        self.labels = torch.from_numpy(np.load(labels_file))
+        with open(meta_file) as f:
+            self.classes = json.load(f)['classes']
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        image = torch.from_numpy(self.images[index:index + 1])
+        image = image.permute(0, 3, 1, 2) if self.raw else normalize(image)
+        return image[0], self.labels[index]
+
+
+class MemmapLoader(object):
+    """Yields (input, target) batches by slicing the memory-mapped cache.
+
+    Args:
+        raw (bool) - yield the uint8 pixels as an NCHW view of the NHWC data instead
+          of normalized float
+        rank, world_size - serve only this rank's contiguous share of the images
+        num_samples (int) - serve only the first num_samples images, a random draw
+          since the cache is stored shuffled; None for all of them
+    """
+    def __init__(self, cache_dir, input_dim, batch_size, raw=False, rank=0, world_size=1, num_samples=None):
+        self.dataset = MemmapDataset(cache_dir, input_dim, raw=raw)
+        self.batch_size = batch_size
+        self.raw = raw
+        count = min(len(self.dataset), num_samples or len(self.dataset))
+        self.start = count * rank // world_size
+        self.end = count * (rank + 1) // world_size
+
+    @property
+    def classes(self):
+        return self.dataset.classes
+
+    def __len__(self):
+        return (self.end - self.start + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(self.start, self.end, self.batch_size):
+            end = min(start + self.batch_size, self.end)
+            images = torch.from_numpy(self.dataset.images[start:end])
+            images = images.permute(0, 3, 1, 2) if self.raw else normalize(images)
+            yield images, self.dataset.labels[start:end]
+
+
+def main():
+    args = parser.parse_args()
+    build(os.path.join(args.data, 'val'), args.cache_dir, args.input_dim, args.workers, args.seed)
+
+
+if __name__ == '__main__':
+    main()